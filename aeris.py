@@ -1,44 +1,137 @@
 #! /usr/bin/env python
 
+import os
 import serial
-from time import sleep
+import queue
+from time import sleep, monotonic
+from threading import Thread, Event
 import argparse
 import logging
 
-from valco import SSV
+from valco import SSV, shared_bus
+from framer import PacketFramer, valid_line, NAMES
+from writer import DataWriter
+from columnar import NpyWriter, RecordBatch
+from runstats import LiveStats
+from scheduler import SequenceScheduler
+from metrics import metrics, MetricsExporter
+from gaps import GapDetector, ReadCadence, gaps_file
+from liveserver import RingBuffer, LiveServer
+from logsetup import setup_logging
+from journal import Journal, ResumeState
 import config as cfg
 
+log = logging.getLogger('aeris')
 
-class Aeris:
 
-    partial = ''
+class AerisReader(Thread):
+    """ Continuous acquisition of Aeris data. The thread blocks on the
+        serial port, frames packets as the bytes arrive and hands them to
+        the consumer through a bounded queue as (host_time, packet) tuples.
+        host_time is time.monotonic() when the packet was completed. """
+
+    def __init__(self, aeris, maxsize=1000):
+        Thread.__init__(self, daemon=True)
+        self.aeris = aeris
+        self.ser = aeris.aeris
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self._done = Event()
+        metrics.counter_func(aeris.metric('queue_dropped'), lambda: self.dropped)
+
+    def run(self):
+        while not self._done.is_set():
+            try:
+                raw = self.ser.read(1)     # blocks for up to the port timeout
+                backlog = self.ser.in_waiting
+                if backlog:
+                    self.aeris.cadence.update(backlog)
+                    raw += self.ser.read(backlog)
+            except serial.serialutil.SerialException as e:
+                log.error(f'Aeris reader stopped: {e}')
+                break
+            if len(raw) == 0:
+                continue
+            with metrics.time(self.aeris.metric('framing')):
+                packets = self.aeris.framer.feed(raw)
+            for p in packets:
+                self.put((monotonic(), p))
+
+    def put(self, item):
+        """ Queue a packet. If the consumer has fallen behind the oldest
+            packet is dropped so the serial port keeps being drained. """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.dropped += 1
+            log.warning(f'Aeris reader queue full, dropped packet ({self.dropped} total)')
+            self.queue.put_nowait(item)
+
+    def drain(self):
+        """ Returns all of the queued (host_time, packet) tuples. """
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def stop(self):
+        self._done.set()
+        self.join()
 
-    def __init__(self):
+
+class Aeris:
+
+    def __init__(self, continuous=False, settings=None):
+        """ settings: namespace with the config.py names, default config.py
+            itself. A name setting labels the output of one instrument
+            when several run in a process (see rack.py). """
+        self.cfg = cfg if settings is None else settings
+        self.name = getattr(self.cfg, 'name', None)
         self.start_logger()
         self.aeris = self.aeris_connect()
+        self.framer = PacketFramer()
+        self.cadence = ReadCadence(self.cfg.serial_buffer, fastest=self.cfg.read_interval_min)
+        self.count_framer()
+        self.reader = None
+        self.held = []          # (host_time, packet) drained but not returned yet
+        if continuous:
+            self.reader = AerisReader(self, maxsize=self.cfg.aeris_queue_size)
+            self.reader.start()
 
     def start_logger(self):
-        file = f'{cfg.aeris_logfile}'
-        logging.basicConfig(filename=file, filemode='w',
-                level=logging.DEBUG,
-                format='%(asctime)s.%(msecs)03d, %(levelname)s: %(message)s',
-                datefmt='%Y-%m-%d, %H:%M:%S')
+        setup_logging(self.cfg.aeris_logfile, self.cfg.log_level, self.cfg.log_levels,
+            self.cfg.log_rotate_mb, self.cfg.log_backups, self.cfg.log_rotate_hours)
+
+    def metric(self, name):
+        return name if self.name is None else f'{self.name}_{name}'
+
+    def count_framer(self):
+        """ Framer counters in the metrics snapshots """
+        for name, attr in [('bytes_read', 'bytes'), ('packets', 'packets'),
+                ('dropped_lines', 'dropped'), ('dropped_bytes', 'dropped_bytes'),
+                ('decode_errors', 'decode_errors'), ('partial_overflows', 'overflows')]:
+            metrics.counter_func(self.metric(name), lambda attr=attr: getattr(self.framer, attr))
+        metrics.counter_func(self.metric('serial_overruns'), lambda: self.cadence.overruns)
 
     def aeris_connect(self):
         """ Setup serial connection to Aeris N2O/CO instrument """
-        print(f'Connecting to Aeris on port {cfg.aeris_port}')
-        ser = serial.Serial(cfg.aeris_port, timeout=0.05, baudrate=9600)
+        label = 'Aeris' if self.name is None else f'Aeris {self.name}'
+        print(f'Connecting to {label} on port {self.cfg.aeris_port}')
+        ser = serial.Serial(self.cfg.aeris_port, timeout=0.05, baudrate=9600)
         ser.flushInput()
         return ser
 
     def read_data(self):
         """ Reads all data in the serial port buffer. """
-        try:
-            data = self.aeris.read_all().decode()
-        except UnicodeDecodeError:
-            data = ''
-
-        return data
+        with metrics.time(self.metric('read_data')):
+            self.cadence.update(self.aeris.in_waiting)
+            return self.aeris.read_all()
 
     def valid_packet(self, packet):
         """ Criteria for a full data packet from the Aeris instrument.
@@ -46,90 +139,202 @@ class Aeris:
             exactly 23 characters (MM/DD/YYYY HH:MM:SS.sss).
             CHANGE as of 12/17/20: for some unknown reason there are
             now 11 cells of data. """
-        datums = list(filter(None, packet.split(',')))
-        if len(datums) != 11 or len(datums[0]) != 23:
-            return False
-        return True
+        return valid_line(packet)
 
     def return_packets(self):
         """ Parses data from the Aeris instrument. If the serial
             port is read while data is coming from the instrument, the packet
-            will be cut into a partial packet. The parsing routine saves
-            the partial packet and appends the remainder after the next
-            serial port read. """
-        data = self.read_data()
-        packets = []
-
-        if len(data) == 0:
-            return packets
-
-        # handle a scenario where the \r\n charaters are split across
-        # two packets.
-        if data[-1] == '\r':
-            data += '\n'
-        if data[0] == '\n':
-            data = data[1:]
-
-        # parse data packets between \r\n
-        for packet in filter(None, data.split('\r\n')):
-            if not self.valid_packet(packet):
-                # not a complete packet, add next packet to it.
-                self.partial = self.partial + packet
-                if self.valid_packet(self.partial):
-                    packets.append(self.partial)
-                    self.partial = ''
-                elif len(self.partial) > 110:
-                    # something went wrong try to reset
-                    logging.warning(f'partial packet length too long: {self.partial}')
-                    self.partial = ''
-            else:
-                packets.append(packet)
-
-        return packets
+            will be cut into a partial packet. The framer keeps the partial
+            packet and completes it after the next serial port read. """
+        raw = self.read_data()
+        with metrics.time(self.metric('framing')):
+            return self.framer.feed(raw)
+
+    def next_packets(self, before=None):
+        """ Packets received since the last call. In continuous mode they
+            come from the reader thread, otherwise the port is polled.
+            before: monotonic() time, only the packets the reader completed
+            before then are returned, the later ones on the next call.
+            In polled mode nothing is known to be before, [] is returned. """
+        if self.reader is None:
+            return [] if before is not None else self.return_packets()
+        items = self.held + self.reader.drain()
+        if before is None:
+            self.held = []
+            return [p for t, p in items]
+        self.held = [(t, p) for t, p in items if t >= before]
+        return [p for t, p in items if t < before]
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
 
     def test(self, seconds):
         """ Reads the serial port for Aeris data """
         for n in range(seconds):
-            pks = self.return_packets()
+            pks = self.next_packets()
             for p in pks:
                 print(p)
             sleep(1)
+        self.close()
 
 
 class Instrument(Aeris):
 
-    newfile = True
+    header = ','.join(NAMES + ('ssv', 'seq_count'))
 
-    def __init__(self):
-        super().__init__()
-        self.ssv = SSV(cfg.ssv_add, port=cfg.ssv_port)
+    def __init__(self, continuous=False, settings=None):
+        super().__init__(continuous=continuous, settings=settings)
+        self.ssv = SSV(self.cfg.ssv_add, bus=shared_bus(self.cfg.ssv_port), metric=self.metric('ssv_go'))
         self.ssv.verbose = True
+        self.writer = DataWriter(self.cfg.aeris_datafile, self.header,
+            namefmt=self.cfg.aeris_datafile_fmt,
+            flush_interval=self.cfg.flush_interval, flush_lines=self.cfg.flush_lines,
+            fsync=self.cfg.fsync, rotate_daily=self.cfg.rotate_daily,
+            rotate_bytes=self.cfg.rotate_mb * 1024**2)
+        self.npy = None
+        if self.cfg.save_npy:
+            self.npy = NpyWriter(os.path.splitext(self.cfg.aeris_datafile)[0] + '.npy',
+                flush_interval=self.cfg.flush_interval, flush_lines=self.cfg.flush_lines,
+                fsync=self.cfg.fsync)
+        self.writer.on_rotate.append(self.rotated)
+        self.batch = RecordBatch()
+        self.live = LiveStats()
+        self.gaps = None
+        if self.cfg.gap_detect:
+            self.gaps = GapDetector(gaps_file(self.writer.path), self.cfg.aeris_period, self.cfg.gap_tolerance)
+            metrics.counter_func(self.metric('missing_packets'), lambda: self.gaps.missing)
+            metrics.counter_func(self.metric('gaps'), lambda: self.gaps.gaps)
+        self.ring = RingBuffer(self.cfg.live_rows)
+        self.server = None
+        if self.cfg.live_port:
+            try:
+                self.server = LiveServer(self.ring, self.cfg.live_port)
+            except OSError as e:
+                # the live data server is optional, acquisition goes on without it
+                msg = f'live data server not started on port {self.cfg.live_port}: {e}'
+                print(msg if self.name is None else f'{self.name}: {msg}')
+                log.error(msg)
+        self.step = None        # (ssv_position, seq_count) of the running step
+        self.halt = Event()
+        self.journal = Journal(self.cfg.journal_file) if self.cfg.journal_file else None
+        self.exporter = None
+        if self.cfg.metrics_file or self.cfg.metrics_port:
+            self.exporter = MetricsExporter(self.cfg.metrics_file, self.cfg.metrics_interval, self.cfg.metrics_port)
+            self.exporter.start()
 
     def save_aeris(self, packet, ssv_position, seq_count):
-        """ Save data packets with SSV postion to a .csv file """
-        with open(cfg.aeris_datafile, 'a') as f:
-            for p in filter(None, packet):
-                p = f'{p},{ssv_position:02d},{seq_count:02d}'
-                if self.newfile:
-                    f.write('datetime,inlet_num,press_gas,temp_gas,n2o,h2o,co,temp_amb,code,ukw1,ukw2,ssv,seq_count\n')
-                    self.newfile = False
-                f.write(p+'\n')
-                print(p)
+        """ Save data packets with SSV postion to a .csv file
+            and optionally to a typed .npy file. The packets are parsed
+            once, the returned records are shared with the live statistics
+            and are only valid until the next call. """
+        with metrics.time(self.metric('save_aeris')):
+            packet = list(filter(None, packet))
+            records = self.batch.parse(packet, ssv_position, seq_count)
+            lines = [f'{p},{ssv_position:02d},{seq_count:02d}' for p in packet]
+            self.writer.write(lines)
+            if self.npy is not None:
+                self.npy.write(records)
+            if self.gaps is not None:
+                self.gaps.feed(records)
+            self.ring.append(records)
+            if lines and self.cfg.echo:
+                print('\n'.join(lines))
+            return records
+
+    def rotated(self, path):
+        """ The .csv data file rotated to path, the files that pair with
+            it follow with the same name root """
+        if self.npy is not None:
+            self.npy.reopen(os.path.splitext(path)[0] + '.npy')
+        if self.gaps is not None and self.gaps.writer is not None:
+            self.gaps.writer.reopen(gaps_file(path))
+
+    def report(self, txt):
+        if self.name is not None:
+            txt = '\n'.join(f'{self.name}: {line}' for line in txt.split('\n'))
+        print(f'{txt}\n', end='')     # one write, lines of other instruments can't cut in
+        log.info(txt)
+
+    def stop(self):
+        """ Ends run() after the current read, the valve goes home """
+        self.halt.set()
 
-    def run(self, seq):
-        """ Run a valve sequence. Store data """
+    def close(self):
+        super().close()
+        self.writer.close()
+        if self.npy is not None:
+            self.npy.close()
+        if self.gaps is not None:
+            self.gaps.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def run(self, seq, resume=None):
+        """ Run a valve sequence. Store data
+            resume: journal.ResumeState of an interrupted run of seq, only
+                its unfinished steps are run. """
         assert isinstance(seq, list)    # seq must be a list()
 
-        for ssv_position, seq_count, duration in seq:
-            self.ssv.go(ssv_position)
-            for sec in range(duration):
-                pks = self.return_packets()
-                self.save_aeris(pks, ssv_position, seq_count)
-                sleep(1)
+        steps = list(enumerate(seq)) if resume is None else resume.steps()
+        sched = SequenceScheduler([step for n, step in steps])
+        if self.journal is not None:
+            self.journal.start(seq, self.writer.path, resumed=resume is not None)
+        try:
+            for (ssv_position, seq_count, duration, end), (n, step) in zip(sched, steps):
+                switch = monotonic()
+                self.ssv.go(ssv_position)
+                sched.switched()
+                if self.step is not None:
+                    # packets the reader completed before the switch, drained
+                    # after it, belong to the previous step
+                    self.live.push(self.save_aeris(self.next_packets(before=switch), *self.step))
+                if self.journal is not None:
+                    self.journal.step(n, ssv_position, seq_count, duration, self.writer.path)
+                self.live.start(ssv_position, seq_count, duration)
+                self.step = (ssv_position, seq_count)
+                # read and save about once a second until the step deadline,
+                # more often when the serial buffer is filling up
+                while not self.halt.is_set():
+                    wait = sched.remaining(end)
+                    if wait <= 0:
+                        break
+                    self.halt.wait(min(self.cadence.interval, wait))
+                    with metrics.time(self.metric('loop')):
+                        pks = self.next_packets()
+                        self.live.push(self.save_aeris(pks, ssv_position, seq_count))
+                # the packets up to the switch
+                self.live.push(self.save_aeris(self.next_packets(), ssv_position, seq_count))
+                self.report(self.live.step_summary())
+                if self.halt.is_set():
+                    self.report(f'stopped in step SSV {ssv_position} seq {seq_count}')
+                    break
+                if self.journal is not None:
+                    self.journal.done(n)
+            self.step = None
 
-        # return the SSV to the "home" position
-        self.ssv.home()
-        sleep(1)
+            # return the SSV to the "home" position
+            self.ssv.home()
+            if not self.halt.is_set():
+                sched.switched()
+                if self.journal is not None:
+                    self.journal.end()
+                sleep(1)
+            self.report(f'Statistics on each SSV:\n{self.live.summary()}')
+            self.report(sched.summary())
+            if self.gaps is not None:
+                self.report(self.gaps.summary())
+        finally:
+            # write out any buffered data
+            self.close()
 
 
 if __name__ == '__main__':
@@ -137,12 +342,33 @@ if __name__ == '__main__':
     opt = argparse.ArgumentParser(description='Aeris N2O/CO instrument.')
     opt.add_argument('-t', action='store', type=int, metavar='SECONDS',
         dest='test', help='Test Aeris. Number of seconds to collect data.')
+    opt.add_argument('--asyncio', action='store_true',
+        help='Run the valve sequence with the asyncio engine (see aioengine.py).')
+    opt.add_argument('--resume', action='store_true',
+        help=f'Finish the sequence interrupted in {cfg.journal_file}, appending to its data file.')
     options = opt.parse_args()
 
     if options.test:
-        aeris = Aeris()
+        aeris = Aeris(continuous=cfg.continuous)
         aeris.test(options.test)
         quit()
 
-    aeris = Instrument()
+    if options.resume:
+        if options.asyncio:
+            opt.error('--resume is not supported by the asyncio engine')
+        state = ResumeState.load(cfg.journal_file)
+        if state is None or state.ended:
+            print(f'Nothing to resume in {cfg.journal_file}')
+            quit()
+        print(f'Resuming: {state}')
+        cfg.aeris_datafile = state.datafile
+        aeris = Instrument(continuous=cfg.continuous)
+        aeris.run(state.seq, resume=state)
+        quit()
+
+    if options.asyncio:
+        from aioengine import AsyncInstrument
+        aeris = AsyncInstrument()
+    else:
+        aeris = Instrument(continuous=cfg.continuous)
     aeris.run(cfg.seq)
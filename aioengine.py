@@ -0,0 +1,154 @@
+#! /usr/bin/env python
+""" asyncio acquisition engine, an alternative to Instrument.run.
+
+    Reading, valve scheduling, writing and status reporting run as
+    cooperating tasks in one event loop, so a slow device does not hold
+    up the others. The Aeris port is read without blocking from an event
+    loop reader callback (POSIX only). The blocking Valco commands run
+    in worker threads, serialized per serial port.
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from itertools import groupby
+from operator import itemgetter
+
+import serial
+
+from aeris import Instrument
+from scheduler import SequenceScheduler
+from metrics import metrics
+
+log = logging.getLogger('aioengine')
+
+_port_locks = {}
+
+
+def port_lock(port):
+    """ One asyncio.Lock per serial port shared by all of its valves """
+    if port not in _port_locks:
+        _port_locks[port] = asyncio.Lock()
+    return _port_locks[port]
+
+
+class AsyncInstrument(Instrument):
+
+    status_interval = 10    # seconds between status lines
+
+    def __init__(self, settings=None):
+        super().__init__(continuous=False, settings=settings)
+        self.received = 0
+        self.loop = None
+        self.queue = None
+        self.between = []       # packets received while the valve switches
+
+    def on_readable(self):
+        """ Event loop callback, the Aeris port has data """
+        try:
+            backlog = self.aeris.in_waiting
+            self.cadence.update(backlog)
+            raw = self.aeris.read(backlog or 1)
+        except serial.serialutil.SerialException as e:
+            log.error(f'Aeris port error: {e}')
+            self.loop.remove_reader(self.aeris.fileno())
+            return
+        with metrics.time(self.metric('framing')):
+            packets = self.framer.feed(raw)
+        for p in packets:
+            self.received += 1
+            if self.step is None:
+                self.between.append(p)      # saved with the next step
+            else:
+                self.enqueue(p)
+
+    def enqueue(self, p):
+        if self.queue.full():
+            self.queue.get_nowait()
+            log.warning('Aeris queue full, dropped packet')
+        self.queue.put_nowait((self.step, p))
+
+    async def valve(self, func, *args):
+        """ Runs a blocking valve command in a worker thread. Commands to
+            valves on the same serial port are run one at a time. """
+        async with port_lock(self.ssv.port):
+            return await self.loop.run_in_executor(None, func, *args)
+
+    async def sequence_task(self, seq):
+        """ Moves the valve and waits out each step. Step ends are absolute
+            times from the start of the sequence. The steps are journaled
+            like Instrument.run, so aeris.py --resume can finish the run. """
+        sched = SequenceScheduler(seq)
+        if self.journal is not None:
+            self.journal.start(seq, self.writer.path)
+        for n, (ssv_position, seq_count, duration, end) in enumerate(sched):
+            await self.valve(self.ssv.go, ssv_position)
+            sched.switched()
+            if self.journal is not None:
+                self.journal.step(n, ssv_position, seq_count, duration, self.writer.path)
+            self.live.start(ssv_position, seq_count, duration)
+            self.step = (ssv_position, seq_count)
+            for p in self.between:
+                self.enqueue(p)
+            self.between = []
+            await asyncio.sleep(max(0, sched.remaining(end)))
+            self.step = None
+            while not self.queue.empty():
+                await asyncio.sleep(0)      # let the writer catch up
+            self.report(self.live.step_summary())
+            if self.journal is not None:
+                self.journal.done(n)
+
+        # return the SSV to the "home" position
+        await self.valve(self.ssv.home)
+        sched.switched()
+        if self.journal is not None:
+            self.journal.end()
+        self.report(f'Statistics on each SSV:\n{self.live.summary()}')
+        self.report(sched.summary())
+        if self.gaps is not None:
+            self.report(self.gaps.summary())
+
+    async def write_task(self):
+        while True:
+            items = [await self.queue.get()]
+            while not self.queue.empty():
+                items.append(self.queue.get_nowait())
+            # save everything queued for the same step in one batch
+            for step, group in groupby(items, key=itemgetter(0)):
+                pks = [p for s, p in group]
+                self.live.push(self.save_aeris(pks, *step))
+
+    async def status_task(self):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            # time based flushes when no data is coming in
+            self.writer.write([])
+            if self.npy is not None:
+                self.npy.write([])
+            print(f'{datetime.now()} {self.name or ""} step {self.step} packets {self.received} '
+                f'queued {self.queue.qsize()} dropped {self.framer.dropped}')
+
+    async def main(self, seq):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=self.cfg.aeris_queue_size)
+        self.aeris.timeout = 0      # non-blocking reads
+        self.aeris.reset_input_buffer()
+        self.loop.add_reader(self.aeris.fileno(), self.on_readable)
+        tasks = [asyncio.create_task(self.write_task()),
+            asyncio.create_task(self.status_task())]
+        try:
+            await self.sequence_task(seq)
+        finally:
+            self.loop.remove_reader(self.aeris.fileno())
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run(self, seq):
+        """ Run a valve sequence. Store data """
+        assert isinstance(seq, list)    # seq must be a list()
+        try:
+            asyncio.run(self.main(seq))
+        finally:
+            self.close()
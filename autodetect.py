@@ -1,21 +1,62 @@
 #! /usr/bin/env python
 """ Converted to python 3.6.  181018 GSD
     Added Omega temp controllers  190606 GSD
+    Ports are probed in parallel, one thread per port.
+    Found ports are cached by USB identity and revalidated with a single
+    probe on the next start.
 """
 
+import os
+import glob
+import json
+import argparse
 import serial
+from serial.tools import list_ports
 from time import sleep
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
 
 READBYTES = 1000
 DELAY = 0.05
 potential_ports = ['/dev/ttyUSB0', '/dev/ttyUSB1', '/dev/ttyUSB2', '/dev/ttyUSB3']
 all_devices = {'adr2000': None, 'valco': None, 'omega_flow': None, 'omega_temp': None}
+CACHE_FILE = os.path.expanduser('~/.serial-autodetect.json')
+
+
+def usb_ports():
+    """ Serial ports of the USB adapters plugged in right now """
+    return sorted(p.device for p in list_ports.comports() if p.vid is not None)
+
+
+def port_ids():
+    """ Stable identity of each serial port: the /dev/serial/by-id name,
+        else VID:PID with the adapter serial number or USB location.
+        Returns {port: identity}. """
+    ids = {}
+    for p in list_ports.comports():
+        if p.vid is None:
+            ids[p.device] = p.device
+        elif p.serial_number:
+            ids[p.device] = f'{p.vid:04x}:{p.pid:04x}:{p.serial_number}'
+        else:
+            ids[p.device] = f'{p.vid:04x}:{p.pid:04x}@{p.location}'
+    for link in glob.glob('/dev/serial/by-id/*'):
+        ids[os.path.realpath(link)] = os.path.basename(link)
+    return ids
 
 
 class SerialAutoDetect():
 
-    def __init__(self, devices=all_devices):
+    def __init__(self, devices=all_devices, ports=None, dynamic=False, cache=True):
+        """ ports: list of ports to probe, default potential_ports
+            dynamic: probe the USB serial ports found on the system instead
+            cache: try the ports in CACHE_FILE first, full scan on a miss
+        """
         self.devices = devices
+        if ports is None:
+            ports = usb_ports() if dynamic else potential_ports
+        self.ports = ports
+        self.cache = cache
         self.baud = {'valco': 9600, 'adr2000': 9600, 'omega_flow': 19200, 'omega_temp': 9600}
         self.cmds = {
             'valco': self.cmd_valco,
@@ -23,9 +64,15 @@ class SerialAutoDetect():
             'omega_flow': self.cmd_omega_flowmeter,
             'omega_temp': self.cmd_omega_temp
         }
+        if cache:
+            self.ids = port_ids()
+            self.revalidate()
         self.assign_ports()
+        if cache:
+            self.save_cache()
 
-    """ Hardcoded commands for each type of device """
+    """ Hardcoded commands for each type of device.
+        Each returns True if the device answered. """
 
     def cmd_valco(self, ser):
         """ Requires a Valco valve on address 1 """
@@ -33,47 +80,99 @@ class SerialAutoDetect():
         ser.write(cmd.encode())
         sleep(DELAY)
         d = ser.read(READBYTES)
-        self.devices['valco'] = ser.port if len(d) > 0 else None
+        return len(d) > 0
 
     def cmd_adr2000(self, ser):
         ser.write('\rRD\r'.encode())
         sleep(DELAY)
         d = ser.read(READBYTES)
-        self.devices['adr2000'] = ser.port if len(d) > 0 else None
+        return len(d) > 0
 
     def cmd_omega_flowmeter(self, ser):
         ser.write('\rA\r'.encode())
         sleep(DELAY)
         d = ser.read(READBYTES)
-        self.devices['omega_flow'] = ser.port if len(d) > 0 else None
+        return len(d) > 0
 
     def cmd_omega_temp(self, ser):
         """ Requires an Omega on address 1 """
         ser.write('*01R01\r'.encode())
         sleep(0.3)      # Omega delay is longer than DELAY
         d = ser.read(READBYTES)
-        try:
-            # v = d[1:].decode()
-            self.devices['omega_temp'] = ser.port if len(d) > 0 else None
-        except UnicodeDecodeError:
-            self.devices['omega_temp'] = None
+        # v = d[1:].decode()
+        return len(d) > 0
 
     def process_cmds(self, device, ser):
         func = self.cmds[device]
         ser.flushInput()
         sleep(DELAY)
-        func(ser)
+        return func(ser)
+
+    def probe_port(self, port, devices):
+        """ Tries each device protocol on one port. The port is opened once
+            and only reconfigured when the baud rate changes.
+            Returns the list of devices that answered. """
+        found = []
+        try:
+            ser = serial.Serial(port, timeout=DELAY)
+        except serial.serialutil.SerialException:
+            print(f'{", ".join(devices)} not found on {port}')
+            return found
+        with ser:
+            by_baud = sorted(devices, key=lambda dev: self.baud[dev])
+            for baud, devs in groupby(by_baud, key=lambda dev: self.baud[dev]):
+                ser.baudrate = baud
+                for dev in devs:
+                    if self.process_cmds(dev, ser):
+                        found.append(dev)
+        return found
 
     def assign_ports(self):
-        for port in potential_ports:
-            for dev, status in self.devices.items():
-                if status is None:
-                    try:
-                        ser = serial.Serial(port, timeout=DELAY, baudrate=self.baud[dev])
-                        self.process_cmds(dev, ser)
-                        ser.close()
-                    except serial.serialutil.SerialException:
-                        print(f'{dev} not found on {port}')
+        devices = [dev for dev, status in self.devices.items() if status is None]
+        if len(devices) == 0 or len(self.ports) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=len(self.ports)) as pool:
+            results = pool.map(self.probe_port, self.ports, [devices]*len(self.ports))
+            # the first port in the list wins if a device answers on several
+            for port, found in zip(self.ports, results):
+                for dev in found:
+                    if self.devices[dev] is None:
+                        self.devices[dev] = port
+
+    def load_cache(self):
+        try:
+            with open(CACHE_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def revalidate(self):
+        """ Finds the cached ports by identity (the /dev name may have
+            changed) and probes each with its cached device only. """
+        cached = self.load_cache()
+        current = {ident: port for port, ident in self.ids.items()}
+        check = {}
+        for dev, status in self.devices.items():
+            port = current.get(cached.get(dev))
+            if status is None and port is not None:
+                check.setdefault(port, []).append(dev)
+        if len(check) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=len(check)) as pool:
+            for port, found in zip(check, pool.map(self.probe_port, check, check.values())):
+                for dev in found:
+                    self.devices[dev] = port
+
+    def save_cache(self):
+        cached = self.load_cache()
+        for dev, port in self.devices.items():
+            if port is not None:
+                cached[dev] = self.ids.get(port, port)
+        try:
+            with open(CACHE_FILE, 'w') as f:
+                json.dump(cached, f, indent=1)
+        except OSError:
+            pass
 
 
 if __name__ == '__main__':
@@ -82,5 +181,12 @@ if __name__ == '__main__':
     dv = {'valco':None}
     auto = SerialAutoDetect(dv)
     '''
-    auto = SerialAutoDetect()
+    opt = argparse.ArgumentParser(description='Serial port autodetect.')
+    opt.add_argument('-d', action='store_true', dest='dynamic',
+        help='probe all USB serial ports found instead of /dev/ttyUSB0-3')
+    opt.add_argument('-f', action='store_false', dest='cache',
+        help=f'full scan, ignore the cached ports in {CACHE_FILE}')
+    options = opt.parse_args()
+
+    auto = SerialAutoDetect(dynamic=options.dynamic, cache=options.cache)
     print(auto.devices)
@@ -0,0 +1,536 @@
+#! /usr/bin/env python
+""" Benchmarks for the Aeris acquisition and analysis hot paths.
+
+    framing: the byte level PacketFramer and Aeris.return_packets against
+    the original string split/concat parser on synthetic streams. Both
+    are first checked to return the packets of the original parser on
+    clean streams.
+    write: Instrument.save_aeris throughput to .csv and .npy files.
+    stats: stats.py load, trim and tables, and the streaming statistics
+    on generated data files of 10k rows and up. The settling detector is
+    first checked on steps delayed by a stretch of the previous gas, and
+    the streamed and cached tables against the in-memory tables.
+    valco: Valves.scan and cp polling on an in-process fake serial port.
+    valco-pty: the original fixed delay send/read/flush against the
+    terminator aware transact, on a pty valve emulator (simulator.py).
+
+    Results are saved to a JSON file (-o). Run with --compare on an
+    earlier results file to flag regressions.
+"""
+
+import os
+import sys
+import json
+import platform
+import tempfile
+import argparse
+import random
+import logging
+import warnings
+import contextlib
+from datetime import datetime, timedelta
+from time import perf_counter
+from types import SimpleNamespace
+
+import numpy as np
+
+from framer import PacketFramer
+from simulator import aeris_packet
+
+SUITES = ('framing', 'write', 'stats', 'valco', 'valco-pty')
+results = []        # filled by the bench_* functions
+failed = []         # correctness checks that failed
+
+
+def record(name, value, unit, better='higher'):
+    """ Adds one result. better: 'higher' for rates, 'lower' for times """
+    results.append({'name': name, 'value': value, 'unit': unit, 'better': better})
+
+
+class LegacyParser:
+    """ The string based parser that used to live in Aeris.return_packets """
+
+    partial = ''
+
+    def valid_packet(self, packet):
+        datums = list(filter(None, packet.split(',')))
+        if len(datums) != 11 or len(datums[0]) != 23:
+            return False
+        return True
+
+    def feed(self, raw):
+        try:
+            data = raw.decode()
+        except UnicodeDecodeError:
+            data = ''
+        packets = []
+
+        if len(data) == 0:
+            return packets
+
+        if data[-1] == '\r':
+            data += '\n'
+        if data[0] == '\n':
+            data = data[1:]
+
+        for packet in filter(None, data.split('\r\n')):
+            if not self.valid_packet(packet):
+                self.partial = self.partial + packet
+                if self.valid_packet(self.partial):
+                    packets.append(self.partial)
+                    self.partial = ''
+                elif len(self.partial) > 110:
+                    self.partial = ''
+            else:
+                packets.append(packet)
+
+        return packets
+
+
+def synthetic_packets(n, rate=1, seed=0):
+    """ n Aeris packets sampled at rate Hz """
+    rnd = random.Random(seed)
+    t = datetime(2021, 4, 1, 17, 10, 39)
+    dt = timedelta(seconds=1/rate)
+    packets = []
+    for i in range(n):
+        packets.append(aeris_packet(t, rnd))
+        t += dt
+    return packets
+
+
+def chunk_stream(packets, mode, seed=0, corrupt=0.0):
+    """ Cuts a stream of packets into serial reads.
+        mode: 'aligned' one read per packet, 'batched' 1 s reads of many
+        packets, 'fragmented' random 1-64 byte reads, 'bytewise' 1-4 bytes.
+        corrupt: fraction of packets with an undecodable byte. """
+    rnd = random.Random(seed)
+    if corrupt:
+        packets = [p[:30] + b'\xff' + p[31:] if rnd.random() < corrupt else p for p in packets]
+    if mode == 'aligned':
+        return list(packets)
+    stream = b''.join(packets)
+    if mode == 'batched':
+        size = 50 * len(packets[0])
+        return [stream[i:i+size] for i in range(0, len(stream), size)]
+    lo, hi = (1, 64) if mode == 'fragmented' else (1, 4)
+    chunks, i = [], 0
+    while i < len(stream):
+        n = rnd.randint(lo, hi)
+        chunks.append(stream[i:i+n])
+        i += n
+    return chunks
+
+
+class FakeAerisPort:
+    """ Serial port stand in, read_all returns the chunk set by feed """
+
+    def __init__(self):
+        self.chunk = b''
+
+    @property
+    def in_waiting(self):
+        return len(self.chunk)
+
+    def read_all(self):
+        return self.chunk
+
+
+class AerisParser:
+    """ Aeris.return_packets on a fake port, without opening a serial port """
+
+    def __init__(self):
+        from aeris import Aeris
+        from gaps import ReadCadence
+        self.aeris = Aeris.__new__(Aeris)
+        self.aeris.name = None
+        self.aeris.aeris = FakeAerisPort()
+        self.aeris.framer = PacketFramer()
+        # buffer larger than any chunk, the batched stream is not an overrun
+        self.aeris.cadence = ReadCadence(buffer=1 << 20)
+
+    def feed(self, raw):
+        self.aeris.aeris.chunk = raw
+        return self.aeris.return_packets()
+
+
+def time_parser(parser, chunks, repeat=3):
+    """ Best of repeat, returns (seconds, packets found) """
+    best, found = float('inf'), 0
+    for r in range(repeat):
+        p = parser()
+        t0 = perf_counter()
+        found = sum(len(p.feed(c)) for c in chunks)
+        best = min(best, perf_counter() - t0)
+    return best, found
+
+
+def check_framer(n=3000):
+    """ PacketFramer and Aeris.return_packets must return the same packets
+        as the legacy parser on clean streams cut every way. Returns a
+        list of failures. """
+    packets = synthetic_packets(n, rate=10)
+    errors = []
+    for mode in ('aligned', 'batched', 'fragmented', 'bytewise'):
+        chunks = chunk_stream(packets, mode)
+        legacy = LegacyParser()
+        expected = [p for c in chunks for p in legacy.feed(c)]
+        for label, parser in [('framer', PacketFramer), ('aeris', AerisParser)]:
+            p = parser()
+            found = [pk for c in chunks for pk in p.feed(c)]
+            if found != expected:
+                errors.append(f'{mode}: {label} returned {len(found)} packets, legacy {len(expected)}'
+                    + ('' if len(found) != len(expected) else ', packets differ'))
+    return errors
+
+
+def bench_framing(n, repeat=3):
+    logging.disable(logging.WARNING)
+    errors = check_framer()
+    print(f'framer packets same as legacy: {"FAILED" if errors else "ok"}')
+    for e in errors:
+        print(f'  {e}')
+    failed.extend(errors)
+    packets = synthetic_packets(n, rate=100)
+    print(f'{"stream":<20}{"parser":<10}{"sec":>10}{"packets":>10}{"pkt/s":>12}')
+    for mode, corrupt in [('aligned', 0), ('batched', 0), ('fragmented', 0),
+            ('bytewise', 0), ('fragmented', 0.01)]:
+        chunks = chunk_stream(packets, mode, corrupt=corrupt)
+        name = f'{mode}{"+corrupt" if corrupt else ""}'
+        for label, parser in [('legacy', LegacyParser), ('framer', PacketFramer),
+                ('aeris', AerisParser)]:
+            sec, found = time_parser(parser, chunks, repeat)
+            print(f'{name:<20}{label:<10}{sec:>10.4f}{found:>10d}{found/sec:>12.0f}')
+            record(f'framing/{name}/{label}', found/sec, 'pkt/s')
+    logging.disable(logging.NOTSET)
+
+
+def bench_write(n, repeat=3):
+    """ Instrument.save_aeris in batches of 10 packets (10 Hz data read
+        once a second) with the configured flush policy. """
+    import config as cfg
+    from aeris import Instrument
+    from writer import DataWriter
+    from columnar import NpyWriter, RecordBatch
+    from liveserver import RingBuffer
+
+    packets = [p.decode()[:-2] for p in synthetic_packets(n, rate=10)]
+    batches = [packets[i:i+10] for i in range(0, n, 10)]
+    print(f'{"save_aeris":<20}{"files":<10}{"sec":>10}{"packets":>10}{"pkt/s":>12}')
+    for label, npy in [('csv', False), ('csv+npy', True)]:
+        best = float('inf')
+        for r in range(repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                inst = Instrument.__new__(Instrument)
+                inst.cfg = SimpleNamespace(echo=False)
+                inst.name = None
+                inst.batch = RecordBatch()
+                inst.gaps = None
+                inst.ring = RingBuffer(72000)
+                inst.writer = DataWriter(os.path.join(tmp, 'aeris.csv'), Instrument.header,
+                    flush_interval=cfg.flush_interval, flush_lines=cfg.flush_lines)
+                inst.npy = NpyWriter(os.path.join(tmp, 'aeris.npy'),
+                    flush_interval=cfg.flush_interval, flush_lines=cfg.flush_lines) if npy else None
+                with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                    t0 = perf_counter()
+                    for i, batch in enumerate(batches):
+                        inst.save_aeris(batch, 1 + i // 30 % 8, i // 240)
+                    inst.writer.close()
+                    if inst.npy is not None:
+                        inst.npy.close()
+                    best = min(best, perf_counter() - t0)
+        print(f'{"":<20}{label:<10}{best:>10.4f}{n:>10d}{n/best:>12.0f}')
+        record(f'write/save_aeris/{label}', n/best, 'pkt/s')
+
+
+def synthetic_dataset(rows, segment=300, positions=8, seed=0, delay=None, tau=10):
+    """ DataFrame of rows 1 Hz records as written by Instrument, ssv
+        switching every segment rows. With delay, each ssv position has
+        its own level and a segment starts with delay rows at the level
+        of the previous segment, then approaches its own level with time
+        constant tau rows, like the gas after a valve switch. """
+    import pandas as pd
+    from columnar import DTYPE
+
+    rng = np.random.default_rng(seed)
+    data = np.zeros(rows, dtype=DTYPE)
+    data['datetime'] = np.datetime64('2021-04-01T17:10:39.000') + np.arange(rows) * np.timedelta64(1, 's')
+    step = np.arange(rows) // segment
+    data['ssv'] = 1 + step % positions
+    data['seq_count'] = step // positions
+    data['inlet_num'] = 1
+    data['press_gas'] = 101.32
+    data['temp_gas'] = 45.21
+    n2o, co = np.full(rows, 0.332), np.full(rows, 0.152)
+    if delay is not None:
+        n2o += 0.002 * (data['ssv'] - 1)
+        co += 0.001 * (data['ssv'] - 1)
+        pos = np.arange(rows) % segment
+        left = np.where(pos < delay, 1.0, np.exp(-(pos - delay) / tau))   # part of the step still to go
+        n2o += (np.roll(n2o, segment) - n2o) * left
+        co += (np.roll(co, segment) - co) * left
+    data['n2o'] = n2o + rng.normal(0, 4e-4, rows)
+    data['h2o'] = 12.3
+    data['co'] = co + rng.normal(0, 3e-4, rows)
+    data['temp_amb'] = 25.1
+    return pd.DataFrame(data)
+
+
+def check_settle(delay=50, segment=300, positions=8):
+    """ stats.settle detect on segments that start with delay rows of the
+        previous gas: every cut must be after the delay and the trimmed
+        means at the level of the segment. Returns a list of failures. """
+    import stats
+
+    df = synthetic_dataset(segment * positions * 2, segment, positions, delay=delay)
+    keep, cuts = stats.settle(df, 'detect')
+    errors = []
+    for state, c in cuts[(cuts['cut'] < delay) | (cuts['method'] != 'detect')].iterrows():
+        errors.append(f'segment {state} cut at row {c["cut"]} ({c["method"]}), the step starts at row {delay}')
+    means = df[keep].groupby('ssv')['n2o'].mean()
+    for ssv, mean in means.items():
+        if abs(mean - (0.332 + 0.002 * (ssv - 1))) > 2e-4:
+            errors.append(f'SSV {ssv} trimmed n2o mean {mean:.6f}, level {0.332 + 0.002 * (ssv - 1):.6f}')
+    return errors
+
+
+def write_dataset(df, path):
+    """ Saves the dataset as a .csv file like aeris.py, or a .npy file """
+    from columnar import DTYPE
+    if path.endswith('.npy'):
+        np.save(path, df.to_records(index=False).astype(DTYPE))
+        return
+    out = df.copy()
+    out['datetime'] = out['datetime'].dt.strftime('%m/%d/%Y %H:%M:%S.%f').str[:23]
+    out.to_csv(path, index=False, float_format='%.6g')
+
+
+def check_stream(rows=20000):
+    """ stats.stream on .csv and .npy files, and with the cache on a file
+        written in two parts, must give the tables of stats.tables on the
+        loaded file. Returns a list of failures. """
+    import stats
+
+    df = synthetic_dataset(rows)
+    errors = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for ext in ('csv', 'npy'):
+            path = os.path.join(tmp, f'aeris.{ext}')
+            write_dataset(df, path)
+            expected = stats.tables(stats.trim(stats.load(path)))
+            runs = [('stream', stats.stream(path))]
+            cached = os.path.join(tmp, f'cached.{ext}')
+            write_dataset(df[:rows // 2], cached)
+            stats.stream(cached, cache=True)
+            write_dataset(df, cached)
+            runs.append(('cache', stats.stream(cached, cache=True)))
+            for label, found in runs:
+                for name, a, b in zip(('by_segment', 'by_ssv'), expected, found):
+                    if not (a.index.equals(b.index) and a.columns.equals(b.columns)):
+                        errors.append(f'{label}/{ext} {name}: rows or columns differ from stats.tables')
+                    elif not np.allclose(a.values, b.values, rtol=1e-9, atol=0, equal_nan=True):
+                        errors.append(f'{label}/{ext} {name}: values differ from stats.tables')
+    return errors
+
+
+def bench_stats(sizes, repeat=1):
+    import stats
+
+    warnings.simplefilter('ignore', FutureWarning)     # pandas deprecations in stats.py
+    errors = check_settle()
+    print(f'settle detect on delayed steps: {"FAILED" if errors else "ok"}')
+    for e in errors:
+        print(f'  {e}')
+    failed.extend(errors)
+    errors = check_stream()
+    print(f'streamed and cached tables same as in memory: {"FAILED" if errors else "ok"}')
+    for e in errors:
+        print(f'  {e}')
+    failed.extend(errors)
+    print(f'{"stats":<20}{"rows":>10}{"sec":>10}{"rows/s":>12}')
+    for rows in sizes:
+        df = synthetic_dataset(rows)
+        with tempfile.TemporaryDirectory() as tmp:
+            for ext in ('csv', 'npy'):
+                path = os.path.join(tmp, f'aeris.{ext}')
+                write_dataset(df, path)
+                steps = [(f'load/{ext}', lambda: stats.load(path))]
+                if ext == 'csv':
+                    loaded = stats.load(path)
+                    steps += [('trim', lambda: stats.trim(loaded.copy())),
+                        ('trim/detect', lambda: stats.trim(loaded.copy(), 'detect')),
+                        ('trim+tables', lambda: stats.tables(stats.trim(loaded.copy())))]
+                steps.append((f'stream/{ext}', lambda: stats.stream(path)))
+                for name, func in steps:
+                    best = float('inf')
+                    for r in range(repeat):
+                        t0 = perf_counter()
+                        func()
+                        best = min(best, perf_counter() - t0)
+                    print(f'{name:<20}{rows:>10d}{best:>10.4f}{rows/best:>12.0f}')
+                    record(f'stats/{name}/{rows}', rows/best, 'rows/s')
+
+
+class FakeValcoPort:
+    """ In-process serial port answering like the valve emulator, so the
+        benchmark times the software and not the serial line. """
+
+    def __init__(self, valves):
+        from simulator import ValcoSimulator
+        self.sim = ValcoSimulator.__new__(ValcoSimulator)
+        self.sim.valves = valves
+        self.sim.numports = 10
+        self.sim.pos = {add: 1 if kind == 'ssv' else 'A' for add, kind in valves.items()}
+        self.sim.commands = 0
+        self.rx = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def write(self, data):
+        for line in data.split(b'\n')[:-1]:
+            reply = self.sim.reply(line.decode().strip())
+            if reply is not None:
+                self.rx += f'{reply}\r'.encode()
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def flushInput(self):
+        self.rx.clear()
+
+    def close(self):
+        pass
+
+
+def bench_valco_fake(polls=1000, repeat=3):
+    from valco import ValcoBus, Valves
+
+    class FakeBus(ValcoBus):
+        def connect(self):
+            return FakeValcoPort({1: 'ssv', 2: 'gsv', 3: 'ssv'})
+
+    v = Valves(bus=FakeBus(port='fake'))
+    print(f'{"valco (fake port)":<20}{"calls":>10}{"sec":>10}{"calls/s":>12}')
+    for name, calls, func in [('scan(range(10))', 10, lambda: v.scan(range(10))),
+            ('cp', polls, lambda: [v.cp(1 + n % 3) for n in range(polls)])]:
+        best = float('inf')
+        for r in range(repeat):
+            t0 = perf_counter()
+            func()
+            best = min(best, perf_counter() - t0)
+        print(f'{name:<20}{calls:>10d}{best:>10.4f}{calls/best:>12.0f}')
+        record(f'valco/{name}', calls/best, 'calls/s')
+
+
+def bench_valco(polls=50):
+    from valco import Valves
+    from simulator import ValcoSimulator
+
+    class LegacyValves(Valves):
+        """ cp as it was: send, fixed delay, read(100) and flush """
+        def cp(self, add):
+            self.send_cmd(add, 'cp')
+            return self.read_cmd()
+
+    sim = ValcoSimulator({1: 'ssv', 2: 'gsv', 3: 'ssv'}, latency=0.002)
+    sim.start()
+    print(f'{"valco":<20}{"method":<10}{"sec":>10}')
+    for label, cls in [('legacy', LegacyValves), ('transact', Valves)]:
+        v = cls(port=sim.port)
+        t0 = perf_counter()
+        v.scan(range(10))
+        sec = perf_counter() - t0
+        print(f'{"scan(range(10))":<20}{label:<10}{sec:>10.4f}')
+        record(f'valco-pty/scan/{label}', sec, 's', better='lower')
+        t0 = perf_counter()
+        for n in range(polls):
+            v.cp(1 + n % 3)
+        sec = perf_counter() - t0
+        print(f'{f"cp x {polls}":<20}{label:<10}{sec:>10.4f}')
+        record(f'valco-pty/cp/{label}', sec/polls, 's', better='lower')
+        v.ser.close()
+    sim.stop()
+
+
+def save(file):
+    with open(file, 'w') as f:
+        json.dump({'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'machine': platform.node(),
+            'results': results}, f, indent=1)
+    print(f'\nresults saved to {file}')
+
+
+def compare(file, tolerance=0.1):
+    """ Compares the results with a saved run. Returns the number of
+        results worse by more than tolerance (a fraction). """
+    with open(file) as f:
+        base = {r['name']: r for r in json.load(f)['results']}
+    print(f'\ncompared with {file}')
+    print(f'{"benchmark":<36}{"baseline":>12}{"now":>12}{"change":>9}')
+    regressions = 0
+    for r in results:
+        b = base.get(r['name'])
+        if b is None or b['value'] == 0:
+            continue
+        change = r['value'] / b['value'] - 1
+        worse = -change if r['better'] == 'higher' else change
+        flag = ''
+        if worse > tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f'{r["name"]:<36}{b["value"]:>12.4g}{r["value"]:>12.4g}{change*100:>+8.1f}%{flag}')
+    print(f'{regressions} regressions (tolerance {tolerance*100:.0f}%)')
+    return regressions
+
+
+if __name__ == '__main__':
+
+    opt = argparse.ArgumentParser(description='Aeris hot path micro-benchmarks.')
+    opt.add_argument('-n', action='store', type=int, default=100000, metavar='PACKETS',
+        dest='n', help='Number of synthetic packets (default 100000).')
+    opt.add_argument('-r', action='store', type=int, default=3,
+        dest='repeat', help='Repeats, best time is reported (default 3).')
+    opt.add_argument('-s', action='store', default='framing,write,stats,valco', dest='suites',
+        help=f'Comma separated benchmarks to run, from {",".join(SUITES)} '
+            '(default framing,write,stats,valco).')
+    opt.add_argument('--rows', action='store', default='10000,100000,1000000',
+        help='Comma separated stats dataset sizes (default 10000,100000,1000000). '
+            '10000000 needs several GB of memory.')
+    opt.add_argument('--valco', action='store_true',
+        help='Also run the Valco valve benchmark on a pty emulator.')
+    opt.add_argument('-o', action='store', default='benchmark.json', dest='output',
+        help='Results file (default benchmark.json).')
+    opt.add_argument('--compare', action='store', metavar='BASELINE',
+        help='Flag results worse than the BASELINE results file, exit status 1 on regressions.')
+    opt.add_argument('--tolerance', action='store', type=float, default=10,
+        help='Percent change allowed before a regression is flagged (default 10).')
+    options = opt.parse_args()
+
+    suites = options.suites.split(',')
+    if options.valco:
+        suites.append('valco-pty')
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        opt.error(f'unknown benchmark {", ".join(unknown)}')
+
+    if 'framing' in suites:
+        bench_framing(options.n, options.repeat)
+    if 'write' in suites:
+        bench_write(options.n, options.repeat)
+    if 'stats' in suites:
+        bench_stats([int(n) for n in options.rows.split(',')])
+    if 'valco' in suites:
+        bench_valco_fake(repeat=options.repeat)
+    if 'valco-pty' in suites:
+        bench_valco()
+
+    save(options.output)
+    if options.compare and compare(options.compare, options.tolerance/100):
+        sys.exit(1)
+    if failed:
+        sys.exit(1)
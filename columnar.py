@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+""" Typed, append friendly binary storage of Aeris data.
+
+    Records are stored in a NumPy .npy file with a fixed dtype. The file
+    header is padded to a fixed size so the row count can be rewritten in
+    place after every append. The files open with np.load(file) or
+    np.load(file, mmap_mode='r') without parsing any text.
+
+    Run columnar.py on existing .csv data files to convert them.
+"""
+
+import os
+import struct
+import logging
+import argparse
+import numpy as np
+
+from framer import NAMES
+from writer import DataWriter
+
+log = logging.getLogger('columnar')
+
+DTYPE = np.dtype([('datetime', 'M8[ms]')]
+    + [(name, 'f8') for name in NAMES[1:]]
+    + [('ssv', 'i2'), ('seq_count', 'i2')])
+
+MAGIC = b'\x93NUMPY\x01\x00'
+HEADER_SIZE = 1024      # fixed so the header can be rewritten in place
+
+
+def npy_header(rows):
+    """ .npy version 1.0 header for rows records """
+    d = f"{{'descr': {np.lib.format.dtype_to_descr(DTYPE)!r}, 'fortran_order': False, 'shape': ({rows},), }}"
+    n = HEADER_SIZE - len(MAGIC) - 2
+    return MAGIC + struct.pack('<H', n) + d.ljust(n - 1).encode() + b'\n'
+
+
+def number(cell):
+    try:
+        return float(cell)
+    except ValueError:
+        return np.nan
+
+
+class RecordBatch:
+    """ Parse once stage: validated Aeris packets (str) to DTYPE records.
+
+        Records are written into a preallocated array that is reused for
+        every batch, parse() returns a view of the filled rows. Consumers
+        (writers, live statistics, gap detection) share the view without
+        copying and must not keep it after the next parse(). """
+
+    def __init__(self, capacity=1024):
+        self.buf = np.zeros(capacity, dtype=DTYPE)
+
+    def parse(self, packets, ssv_position, seq_count):
+        n = len(packets)
+        if n > len(self.buf):
+            self.buf = np.zeros(max(n, 2 * len(self.buf)), dtype=DTYPE)
+        rec = self.buf[:n]
+        for i, p in enumerate(packets):
+            cells = p.split(',')
+            if '' in cells:
+                cells = list(filter(None, cells))   # empty cells are ignored, as in valid_line
+            s = cells[0]
+            # MM/DD/YYYY HH:MM:SS.sss to ISO 8601
+            t = f'{s[6:10]}-{s[0:2]}-{s[3:5]}T{s[11:]}'
+            try:
+                rec[i] = (t, *map(float, cells[1:len(NAMES)]), ssv_position, seq_count)
+            except ValueError:
+                # empty or corrupted cells are NaN, a bad time stamp NaT
+                rec[i] = ('NaT', *map(number, cells[1:len(NAMES)]), ssv_position, seq_count)
+                try:
+                    rec['datetime'][i] = t
+                except ValueError:
+                    pass
+        return rec
+
+
+def to_records(packets, ssv_position, seq_count):
+    """ Aeris packets (str) to a new array of DTYPE records """
+    return RecordBatch(len(packets)).parse(packets, ssv_position, seq_count)
+
+
+class NpyWriter(DataWriter):
+    """ DataWriter for arrays of DTYPE records, with the same flush policy
+        as the .csv file. aeris.py rotates it with the .csv file (reopen),
+        so each .csv file has a .npy file with the same rows. The row
+        count in the header is updated after each write so readers only
+        see complete records. """
+
+    mode = 'r+b'
+
+    def __init__(self, path, namefmt=None, **kwargs):
+        super().__init__(path, None, namefmt=namefmt, **kwargs)
+
+    def open(self, path):
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, 'wb') as f:
+                f.write(npy_header(0))
+        else:
+            with open(path, 'rb') as f:
+                np.lib.format.read_magic(f)
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+                if dtype != DTYPE or f.tell() != HEADER_SIZE:
+                    raise ValueError(f'{path} is not an Aeris .npy data file')
+            # a write torn by a crash leaves part of a record at the end
+            size = os.path.getsize(path)
+            torn = (size - HEADER_SIZE) % DTYPE.itemsize
+            if torn:
+                log.warning(f'{path}: dropped {torn} bytes of a partial record')
+                os.truncate(path, size - torn)
+        super().open(path)
+
+    def encode(self, records):
+        return records.tobytes()
+
+    def commit(self):
+        rows = (self.f.tell() - HEADER_SIZE) // DTYPE.itemsize
+        self.f.seek(0)
+        self.f.write(npy_header(rows))
+        self.f.seek(0, os.SEEK_END)
+
+
+def convert(csvfile):
+    """ Converts an Aeris .csv data file to .npy, returns the new file name """
+    import pandas as pd
+    df = pd.read_csv(csvfile, dtype={name: 'f8' for name in DTYPE.names[1:-2]})
+    rec = np.empty(len(df), dtype=DTYPE)
+    rec['datetime'] = pd.to_datetime(df['datetime'], format='%m/%d/%Y %H:%M:%S.%f').values
+    for name in DTYPE.names[1:]:
+        rec[name] = df[name].values
+    npyfile = os.path.splitext(csvfile)[0] + '.npy'
+    with open(npyfile, 'wb') as f:
+        f.write(npy_header(len(rec)))
+        f.write(rec.tobytes())
+    return npyfile
+
+
+if __name__ == '__main__':
+
+    opt = argparse.ArgumentParser(description='Convert Aeris .csv data files to .npy')
+    opt.add_argument('csvfiles', nargs='+', help='Aeris .csv data files.')
+    options = opt.parse_args()
+
+    for file in options.csvfiles:
+        print(f'{file} -> {convert(file)}')
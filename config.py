@@ -6,8 +6,47 @@ ssv_add = 9
 ssv_port = '/dev/ttyUSB0'
 aeris_port = '/dev/ttyS0'
 
+# continuous acquisition: a background thread reads the Aeris port and
+# queues packets, otherwise the port is polled once per second.
+continuous = True
+aeris_queue_size = 1000     # max packets held for the acquisition loop
+
 aeris_logfile = 'aeris-log.txt'
-aeris_datafile = f'aeris-{datetime.utcnow().strftime("%Y%m%d-%H%M%S")}.csv'
+log_level = 'DEBUG'
+log_levels = {}         # per module, e.g. {'valco': 'INFO', 'framer': 'WARNING'}
+log_rotate_mb = 10      # rotate the log at this size and at start, 0 is off
+log_rotate_hours = 24   # and every hours from 00:00 UTC, 0 is off
+log_backups = 5         # old logs kept, gzip compressed
+echo = True             # print each data line
+aeris_datafile_fmt = 'aeris-%Y%m%d-%H%M%S.csv'     # strftime format, UTC
+aeris_datafile = datetime.utcnow().strftime(aeris_datafile_fmt)
+
+# data file buffering and rotation
+flush_interval = 10     # seconds between writes to the data file
+flush_lines = 100       # or write once this many lines are waiting
+fsync = False           # fsync the data file after each write
+rotate_daily = True     # start a new data file at 00:00 UTC
+rotate_mb = 0           # start a new data file at this size in MB, 0 is off
+save_npy = True         # also save typed columns to a .npy file (see columnar.py)
+
+# journal of the valve sequence steps for aeris.py --resume (see journal.py), None is off
+journal_file = 'aeris-journal.jsonl'
+
+# lost data detection (see gaps.py), gaps are saved to <datafile>-gaps.csv
+gap_detect = True
+aeris_period = None     # seconds between Aeris packets, None estimates it
+gap_tolerance = 1.5     # an interval longer than gap_tolerance periods is a gap
+serial_buffer = 4096    # bytes in the OS serial input buffer
+read_interval_min = 0.05    # fastest polling of the Aeris port when it backs up
+
+# recent data in memory, served as JSON on http://127.0.0.1:live_port (see liveserver.py)
+live_rows = 72000       # records kept, 2 hours at 10 Hz
+live_port = 8765        # None is off
+
+# hot path metrics (see metrics.py)
+metrics_file = 'aeris-metrics.json'     # snapshot file, None is off
+metrics_interval = 10   # seconds between snapshots
+metrics_port = None     # Prometheus text on http://127.0.0.1:port/metrics, None is off
 
 # create a basic valve sequence
 repeat = 2      # number of times to repeat valve sequence
@@ -15,3 +54,13 @@ dur = 30        # seconds on each port
 valve_seq = [2, 4]
 
 seq = [(pos, n, dur) for n in range(repeat) for pos in valve_seq]
+
+# Several analyzer/valve pairs run from one process with rack.py. Each
+# entry needs a name and overrides the settings above for that instrument.
+# Data files are named <name>-aeris-... unless aeris_datafile_fmt is given.
+# Valves on the same ssv_port share one serial connection.
+instruments = [
+    # {'name': 'aeris1', 'aeris_port': '/dev/ttyUSB1', 'ssv_port': '/dev/ttyUSB0', 'ssv_add': 9},
+    # {'name': 'aeris2', 'aeris_port': '/dev/ttyUSB2', 'ssv_port': '/dev/ttyUSB0', 'ssv_add': 10,
+    #     'seq': [(pos, n, 60) for n in range(3) for pos in [3, 5]], 'live_port': 8766},
+]
@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+""" Incremental byte level framing of the Aeris serial data stream.
+
+    Bytes are appended to a reusable bytearray and only the newly arrived
+    bytes are scanned for the line terminator. Complete lines are validated
+    by counting cells in place instead of splitting them into lists.
+    A corrupted line is dropped on its own, the rest of the read is kept.
+"""
+
+import re
+import logging
+
+log = logging.getLogger('framer')
+
+NAMES = ('datetime', 'inlet_num', 'press_gas', 'temp_gas', 'n2o', 'h2o', 'co',
+    'temp_amb', 'code', 'ukw1', 'ukw2')
+FIELDS = len(NAMES)     # number of data cells in an Aeris packet
+STAMP_WIDTH = 23    # MM/DD/YYYY HH:MM:SS.sss
+MAXLINE = 256       # longest run of bytes kept while waiting for a terminator
+
+_EMPTY_CELLS = re.compile(r',{2,}')
+
+
+def valid_line(line):
+    """ Criteria for a full data packet from the Aeris instrument.
+        A valid packet has 11 non empty cells of data and the first cell
+        is exactly 23 characters (MM/DD/YYYY HH:MM:SS.sss).
+        The cells are counted in place, no list is built. """
+    if line.find(',') == STAMP_WIDTH and line.count(',') == FIELDS - 1:
+        if ',,' not in line and not line.endswith(','):
+            return True
+    elif ',' not in line[:1] + line[-1:] and ',,' not in line:
+        return False
+    # rare: empty cells are ignored when counting
+    line = _EMPTY_CELLS.sub(',', line).strip(',')
+    return line.find(',') == STAMP_WIDTH and line.count(',') == FIELDS - 1
+
+
+class PacketFramer:
+    """ Frames packets from raw serial bytes.
+        feed() returns the list of valid packets (str) completed by the
+        new bytes. Partial packets stay in the buffer until the rest of
+        the packet arrives. """
+
+    def __init__(self, maxline=MAXLINE):
+        self.buf = bytearray()
+        self.maxline = maxline
+        self.scanned = 0        # bytes of buf already searched for b'\n'
+        self.bytes = 0          # bytes fed
+        self.packets = 0
+        self.dropped = 0        # invalid or undecodable lines and overflows
+        self.dropped_bytes = 0
+        self.decode_errors = 0  # lines with undecodable bytes
+        self.overflows = 0      # partial packets longer than maxline
+
+    def feed(self, data):
+        buf = self.buf
+        packets = []
+        self.bytes += len(data)
+        # only the new bytes are searched for the last terminator
+        if buf:
+            buf += data
+            end = buf.rfind(b'\n', self.scanned)
+            block = bytes(buf[:end]) if end >= 0 else None
+            del buf[:end+1]
+        else:
+            end = data.rfind(b'\n')
+            block = data[:end] if end >= 0 else None
+            if end + 1 < len(data):
+                buf += data[end+1:]
+
+        if block is not None:
+            try:
+                lines = block.decode().split('\n')
+            except UnicodeDecodeError:
+                lines = self._decode_lines(block)
+            for line in lines:
+                if line.endswith('\r'):
+                    line = line[:-1]    # \r\n may have been split across reads
+                if valid_line(line):
+                    packets.append(line)
+                elif line:
+                    self._drop(len(line))
+            self.packets += len(packets)
+
+        if len(buf) > self.maxline:
+            # no terminator in sight, something went wrong try to reset
+            log.warning(f'partial packet length too long: {bytes(buf)!r}')
+            self.overflows += 1
+            self._drop(len(buf))
+            buf.clear()
+        self.scanned = len(buf)
+        return packets
+
+    def _decode_lines(self, block):
+        """ Corrupted bytes in block, decode line by line and drop only
+            the lines that can not be decoded. """
+        lines = []
+        for line in block.split(b'\n'):
+            try:
+                lines.append(line.decode())
+            except UnicodeDecodeError:
+                self.decode_errors += 1
+                self._drop(len(line))
+        return lines
+
+    def _drop(self, n):
+        self.dropped += 1
+        self.dropped_bytes += n
+
+    def reset(self):
+        self.buf.clear()
+        self.scanned = 0
@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+""" Detection of lost Aeris data and adaptive serial read cadence.
+
+    GapDetector follows the instrument timestamps (datetime field of the
+    columnar.DTYPE records) and records every hole in the sequence: its size, the number of missing
+    packets and the valve step it happened in. Gaps are logged and saved
+    to a sidecar file next to the data file (aeris-...-gaps.csv), so the
+    data file keeps one format. The completeness of a run is received
+    packets / (received + missing).
+
+    ReadCadence shortens the polling interval of the acquisition loop when
+    the serial input buffer fills up and relaxes it again when the backlog
+    is gone.
+"""
+
+import os
+import logging
+import numpy as np
+
+from writer import DataWriter
+
+log = logging.getLogger('gaps')
+
+
+def stamp(t):
+    """ datetime64[ms] as in the data file, MM/DD/YYYY HH:MM:SS.sss """
+    return t.astype('M8[ms]').item().strftime('%m/%d/%Y %H:%M:%S.%f')[:23]
+
+
+def gaps_file(datafile):
+    return f'{os.path.splitext(datafile)[0]}-gaps.csv'
+
+
+class GapDetector:
+    """ Finds holes in the instrument timestamp sequence.
+        period: seconds between packets, estimated from the first packets
+            if None
+        tolerance: an interval longer than tolerance * period is a gap """
+
+    header = 'start,end,seconds,missing,ssv,seq_count'
+    learn = 20      # intervals used to estimate the period
+
+    def __init__(self, path=None, period=None, tolerance=1.5):
+        self.period = period
+        self.tolerance = tolerance
+        self.intervals = []
+        self.held = []          # (prev, now, dt, ssv, seq_count) fed while learning the period
+        self.last = None        # datetime64 of the latest packet
+        self.received = 0
+        self.missing = 0
+        self.gaps = 0
+        self.out_of_order = 0
+        self.largest = 0.0
+        self.writer = None
+        if path is not None:
+            self.writer = DataWriter(path, self.header, flush_lines=1)
+
+    def feed(self, records):
+        """ records: array of columnar.DTYPE records of one valve step """
+        t = records['datetime'][~np.isnat(records['datetime'])]
+        if len(t) == 0:
+            return
+        self.received += len(t)
+        prev = t[:-1] if self.last is None else np.concatenate(([self.last], t[:-1]))
+        now = t[1:] if self.last is None else t
+        dt = (now - prev) / np.timedelta64(1, 's')
+        self.last = max(t.max(), self.last) if self.last is not None else t.max()
+
+        late = dt <= 0
+        if late.any():
+            self.out_of_order += int(late.sum())
+            log.warning(f'{late.sum()} Aeris packets out of order, first at {stamp(now[late][0])}')
+        fed = (prev, now, dt, records['ssv'][0], records['seq_count'][0])
+        if self.period is None:
+            self.intervals.extend(dt[~late][:self.learn - len(self.intervals)])
+            self.held.append(fed)
+            if len(self.intervals) < self.learn:
+                return
+            self.period = float(np.median(self.intervals))
+            log.info(f'Aeris packet period {self.period:.3f} s')
+            # the intervals fed while learning are checked now
+            batches, self.held = self.held, []
+        else:
+            batches = [fed]
+        for prev, now, dt, ssv_position, seq_count in batches:
+            for i in np.flatnonzero(dt > self.tolerance * self.period):
+                self.gap(prev[i], now[i], dt[i], ssv_position, seq_count)
+
+    def gap(self, start, end, dt, ssv_position, seq_count):
+        missing = max(1, round(dt / self.period) - 1)
+        self.gaps += 1
+        self.missing += missing
+        self.largest = max(self.largest, dt)
+        start, end = stamp(start), stamp(end)
+        log.warning(f'Aeris data gap {start} to {end}: {dt:.3f} s, '
+            f'{missing} packets missing')
+        if self.writer is not None:
+            self.writer.write([f'{start},{end},{dt:.3f},{missing},{ssv_position},{seq_count}'])
+
+    def completeness(self):
+        total = self.received + self.missing
+        return self.received / total * 100 if total else 100.0
+
+    def summary(self):
+        return (f'data completeness {self.completeness():.2f} %: {self.received} packets, '
+            f'{self.missing} missing in {self.gaps} gaps (largest {self.largest:.1f} s), '
+            f'{self.out_of_order} out of order')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class ReadCadence:
+    """ Seconds to wait between serial port reads. The interval is halved
+        when a read finds the input buffer more than high full and doubled
+        back towards slowest when it is below low full. """
+
+    def __init__(self, buffer=4096, fastest=0.05, slowest=1.0, high=0.25, low=0.05):
+        self.buffer = buffer
+        self.fastest = fastest
+        self.slowest = slowest
+        self.high = high
+        self.low = low
+        self.interval = slowest
+        self.peak = 0           # largest backlog seen, bytes
+        self.overruns = 0       # reads that found the buffer full
+
+    def update(self, backlog):
+        """ backlog: bytes waiting in the input buffer before the read """
+        self.peak = max(self.peak, backlog)
+        fill = backlog / self.buffer
+        if fill >= 1:
+            self.overruns += 1
+            log.error(f'Aeris serial buffer full ({backlog} bytes), data may be lost')
+        if fill > self.high and self.interval > self.fastest:
+            self.interval = max(self.fastest, self.interval / 2)
+            log.info(f'Aeris backlog {backlog} bytes, reading every {self.interval:.3f} s')
+        elif fill < self.low and self.interval < self.slowest:
+            self.interval = min(self.slowest, self.interval * 2)
+        return self.interval
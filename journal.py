@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+""" Crash safe journal of the valve sequence.
+
+    One JSON line is appended (and fsync'ed) when a sequence starts or
+    resumes, when each step starts and when it is done, and when the
+    sequence ends. After a crash, aeris.py --resume reads the journal,
+    reopens the data file of the interrupted run, skips the finished
+    steps and runs the interrupted step for its remaining time. The time
+    a step has run is measured up to the last write of its data file, so
+    data still buffered at the crash is taken again.
+
+    Run journal.py to see the state of the last sequence.
+"""
+
+import os
+import json
+import argparse
+from datetime import datetime, timezone
+
+
+def now():
+    return datetime.now(timezone.utc).timestamp()
+
+
+class Journal:
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'a')
+
+    def write(self, event, **fields):
+        self.f.write(json.dumps({'event': event, 'time': now(), **fields}) + '\n')
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def start(self, seq, datafile, resumed=False):
+        self.write('resume' if resumed else 'start', seq=seq, datafile=datafile)
+
+    def step(self, n, ssv_position, seq_count, duration, datafile):
+        self.write('step', n=n, ssv=ssv_position, seq_count=seq_count,
+            duration=duration, datafile=datafile)
+
+    def done(self, n):
+        self.write('done', n=n)
+
+    def end(self):
+        self.write('end')
+
+    def close(self):
+        self.f.close()
+
+
+class ResumeState:
+    """ The last sequence in a journal file """
+
+    def __init__(self, events):
+        start = events[0]
+        self.seq = [tuple(step) for step in start['seq']]
+        self.datafile = start['datafile']
+        self.done = set()
+        self.current = None     # step event of the interrupted step
+        self.ended = False
+        for e in events[1:]:
+            if e['event'] == 'step':
+                self.current = e
+                self.datafile = e['datafile']
+            elif e['event'] == 'done':
+                self.done.add(e['n'])
+                self.current = None
+            elif e['event'] == 'end':
+                self.ended = True
+
+    @classmethod
+    def load(cls, path):
+        """ None if there is no journal or no sequence in it """
+        try:
+            with open(path) as f:
+                lines = f.readlines()
+        except OSError:
+            return None
+        events = []
+        for line in lines:
+            try:
+                e = json.loads(line)
+            except ValueError:
+                continue        # torn last line
+            if e['event'] == 'start':
+                events = []
+            events.append(e)
+        if len(events) == 0 or events[0]['event'] != 'start':
+            return None
+        return cls(events)
+
+    def elapsed(self):
+        """ Seconds the interrupted step ran, up to the last data write """
+        if self.current is None:
+            return 0
+        try:
+            last = os.path.getmtime(self.datafile)
+        except OSError:
+            return 0
+        return max(0, last - self.current['time'])
+
+    def steps(self):
+        """ (n, (ssv_position, seq_count, duration)) left to run, the
+            interrupted step shortened by the time it already ran. The
+            journaled duration of a step that was itself resumed is
+            already shortened. """
+        left = []
+        for n, (ssv_position, seq_count, duration) in enumerate(self.seq):
+            if n in self.done:
+                continue
+            if self.current is not None and n == self.current['n']:
+                duration = max(1, self.current['duration'] - self.elapsed())
+            left.append((n, (ssv_position, seq_count, duration)))
+        return left
+
+    def __str__(self):
+        if self.ended:
+            return f'sequence of {len(self.seq)} steps finished, data in {self.datafile}'
+        txt = f'{len(self.done)} of {len(self.seq)} steps done, data in {self.datafile}'
+        if self.current is not None:
+            txt += (f'\ninterrupted in step {self.current["n"]} SSV {self.current["ssv"]} '
+                f'seq {self.current["seq_count"]} after {self.elapsed():.0f} of '
+                f'{self.current["duration"]} s')
+        return txt
+
+
+if __name__ == '__main__':
+
+    import config as cfg
+
+    opt = argparse.ArgumentParser(description='State of the last valve sequence.')
+    opt.add_argument('file', nargs='?', default=cfg.journal_file,
+        help=f'Journal file (default {cfg.journal_file}).')
+    options = opt.parse_args()
+
+    state = ResumeState.load(options.file)
+    print('no sequence in the journal' if state is None else state)
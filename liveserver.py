@@ -0,0 +1,193 @@
+#! /usr/bin/env python
+""" Recent Aeris data kept in memory and served over local HTTP.
+
+    RingBuffer holds the last capacity records (columnar.DTYPE) in one
+    preallocated array. The acquisition loop appends each parsed batch,
+    readers copy out only the rows they ask for, the lock is held for
+    the copies only.
+
+    LiveServer answers on http://127.0.0.1:port with JSON:
+
+        /latest             the newest record
+        /since?t=T          records with datetime > T (ISO 8601, UTC),
+                            at most limit=N (default 10000) of the oldest
+        /stats?seconds=S    mean, std, pct and count of n2o and co for
+                            each ssv position over the last S seconds of
+                            instrument time (default the whole buffer)
+
+    Run liveserver.py to query a running acquisition from the shell.
+"""
+
+import json
+import math
+import logging
+import argparse
+import urllib.error
+import urllib.request
+from threading import Thread, Lock
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+
+from columnar import DTYPE
+from runstats import RunningStats
+
+log = logging.getLogger('liveserver')
+
+
+class RingBuffer:
+
+    def __init__(self, capacity):
+        self.buf = np.zeros(capacity, dtype=DTYPE)
+        self.head = 0           # next row to write
+        self.count = 0          # rows held
+        self.lock = Lock()
+
+    def append(self, records):
+        records = records[~np.isnat(records['datetime'])]     # kept in time order
+        n = len(records)
+        if n == 0:
+            return
+        cap = len(self.buf)
+        if n > cap:
+            records = records[-cap:]
+            n = cap
+        with self.lock:
+            first = min(n, cap - self.head)
+            self.buf[self.head:self.head+first] = records[:first]
+            self.buf[:n-first] = records[first:]
+            self.head = (self.head + n) % cap
+            self.count = min(cap, self.count + n)
+
+    def segments(self):
+        """ The rows held, oldest first, as up to two views of buf. Call
+            with the lock held. """
+        if self.count < len(self.buf):
+            return [self.buf[:self.count]]
+        return [self.buf[self.head:], self.buf[:self.head]]
+
+    def latest(self):
+        with self.lock:
+            if self.count == 0:
+                return self.buf[:0].copy()
+            return self.buf[self.head-1:self.head or None].copy()
+
+    def since(self, t, limit=None):
+        """ Copy of the records with datetime > t (datetime64) """
+        with self.lock:
+            parts = [seg[np.searchsorted(seg['datetime'], t, side='right'):]
+                for seg in self.segments()]
+            if limit is not None:
+                kept = []
+                for seg in parts:
+                    seg = seg[:max(0, limit - sum(map(len, kept)))]
+                    kept.append(seg)
+                parts = kept
+            return np.concatenate(parts)
+
+    def last_time(self):
+        with self.lock:
+            return self.buf['datetime'][self.head-1] if self.count else None
+
+
+def to_json(records):
+    """ List of dicts with the datetime in ISO 8601 and NaN as null """
+    rows = []
+    for row in records.tolist():
+        d = dict(zip(DTYPE.names, row))
+        d['datetime'] = d['datetime'].isoformat(timespec='milliseconds') if d['datetime'] else None
+        rows.append({k: None if isinstance(v, float) and math.isnan(v) else v for k, v in d.items()})
+    return rows
+
+
+def ssv_stats(records, fields=('n2o', 'co')):
+    """ {ssv: {field: {mean, std, pct, count}}} """
+    out = {}
+    for ssv in np.unique(records['ssv']):
+        sel = records[records['ssv'] == ssv]
+        out[int(ssv)] = {}
+        for f in fields:
+            mean, std, pct, n = RunningStats.from_array(sel[f]).row()
+            out[int(ssv)][f] = {k: None if isinstance(v, float) and math.isnan(v) else v
+                for k, v in zip(('mean', 'std', 'pct', 'count'), (mean, std, pct, n))}
+    return out
+
+
+class LiveServer:
+    """ Serves a RingBuffer on http://127.0.0.1:port from its own threads """
+
+    def __init__(self, ring, port):
+        self.ring = ring
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        log.info(f'live data on http://127.0.0.1:{port}/')
+
+    def query(self, path, args):
+        """ Returns (status, JSON serializable answer) """
+        ring = self.ring
+        if path == '/latest':
+            rec = to_json(ring.latest())
+            return (200, rec[0]) if rec else (404, {'error': 'no data yet'})
+        elif path == '/since':
+            try:
+                t = np.datetime64(args.get('t', ['1970-01-01'])[0], 'ms')
+                limit = int(args.get('limit', [10000])[0])
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            return 200, to_json(ring.since(t, limit))
+        elif path == '/stats':
+            last = ring.last_time()
+            if last is None:
+                return 404, {'error': 'no data yet'}
+            try:
+                seconds = float(args['seconds'][0]) if 'seconds' in args else None
+            except ValueError as e:
+                return 400, {'error': str(e)}
+            t = np.datetime64(0, 'ms') if seconds is None else last - np.timedelta64(int(seconds * 1000), 'ms')
+            rec = ring.since(t)
+            return 200, {'from': str(rec['datetime'][0]) if len(rec) else None,
+                'to': str(last), 'ssv': ssv_stats(rec)}
+        return 404, {'error': f'unknown path {path}, use /latest, /since?t= or /stats?seconds='}
+
+    def handler(self):
+        live = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                status, answer = live.query(url.path, parse_qs(url.query))
+                body = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+
+    import config as cfg
+
+    opt = argparse.ArgumentParser(description='Query the live data of a running aeris.py.')
+    opt.add_argument('query', nargs='?', default='latest',
+        help='latest, since?t=2021-04-01T17:00:00 or stats?seconds=300 (default latest).')
+    opt.add_argument('-p', action='store', type=int, default=cfg.live_port, dest='port',
+        help=f'Port (default {cfg.live_port}).')
+    options = opt.parse_args()
+
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{options.port}/{options.query}') as r:
+            print(json.dumps(json.load(r), indent=1))
+    except urllib.error.HTTPError as e:
+        print(json.load(e)['error'])
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+""" Non blocking logging for the acquisition process.
+
+    Log records are put on a queue by a QueueHandler and written to the
+    log file by a QueueListener thread, so the acquisition and valve
+    threads never wait on disk. The log file is rotated at max_mb, every
+    hours (aligned to 00:00 UTC) and at every start, and old logs are
+    gzip compressed: aeris-log.txt.1.gz is the newest. Each module logs to its own logger (aeris, valco,
+    framer, ...) so levels can be set per module, e.g.
+    log_levels = {'valco': 'INFO'} in config.py.
+"""
+
+import os
+import gzip
+import queue
+import atexit
+import shutil
+import logging
+import logging.handlers
+from time import time
+
+FORMAT = '%(asctime)s.%(msecs)03d, %(levelname)s: %(message)s'
+DATEFMT = '%Y-%m-%d, %H:%M:%S'
+
+_listener = None
+_handler = None         # the QueueHandler on the root logger
+
+
+def gzip_namer(name):
+    return f'{name}.gz'
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f, gzip.open(dest, 'wb') as g:
+        shutil.copyfileobj(f, g)
+    os.remove(source)
+
+
+class RotatingHandler(logging.handlers.RotatingFileHandler):
+    """ RotatingFileHandler that also rotates every hours, at multiples
+        of hours from 00:00 UTC (24 rotates at midnight UTC). """
+
+    def __init__(self, file, max_mb=10, backups=5, hours=0):
+        super().__init__(file, maxBytes=int(max_mb * 1024**2), backupCount=backups, delay=True)
+        self.interval = hours * 3600
+        self.rollover_at = self.next_rollover()
+
+    def next_rollover(self):
+        if not self.interval:
+            return None
+        return (time() // self.interval + 1) * self.interval
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and record.created >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = self.next_rollover()
+
+
+def setup_logging(file, level='DEBUG', levels=None, max_mb=10, backups=5, hours=0):
+    """ Logs the root logger to file through a queue. Only the first call
+        in a process sets up logging, later calls return the same listener.
+        levels: {logger name: level} for single modules
+        max_mb: rotate the file at this size, 0 is off
+        backups: number of old gzip compressed logs kept
+        hours: also rotate every hours, 0 is off. The file is always
+            rotated at start. """
+    global _listener, _handler
+    if _listener is not None:
+        return _listener
+
+    handler = RotatingHandler(file, max_mb, backups, hours)
+    handler.namer = gzip_namer
+    handler.rotator = gzip_rotator
+    handler.setFormatter(logging.Formatter(FORMAT, datefmt=DATEFMT))
+    if backups and os.path.exists(file) and os.path.getsize(file) > 0:
+        handler.doRollover()        # each run starts a new log
+
+    q = queue.SimpleQueue()
+    root = logging.getLogger()
+    _handler = logging.handlers.QueueHandler(q)
+    root.addHandler(_handler)
+    root.setLevel(level)
+    for name, lvl in (levels or {}).items():
+        logging.getLogger(name).setLevel(lvl)
+
+    _listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+
+def stop_logging():
+    """ Writes out the queued records and stops the listener thread """
+    global _listener, _handler
+    if _listener is not None:
+        logging.getLogger().removeHandler(_handler)
+        _listener.stop()
+        for h in _listener.handlers:
+            h.close()
+        _listener = _handler = None
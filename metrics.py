@@ -0,0 +1,269 @@
+#! /usr/bin/env python
+""" Low overhead counters and latency histograms for the acquisition loop.
+
+    The code being measured updates the module level registry:
+
+        with metrics.time('framing'):
+            ...
+        @metrics.timed('save_aeris')
+        metrics.count('bytes_read', len(raw))
+        metrics.counter_func('packets', lambda: framer.packets)
+
+    A timing costs two perf_counter() calls and a bisect into fixed
+    buckets, counters that already exist elsewhere (framer, reader) are
+    only read when a snapshot is taken. Updates are not locked, each
+    metric should be updated from a single thread: when several
+    instruments run in a process their metrics are named per instrument
+    (Aeris.metric).
+
+    MetricsExporter writes a JSON snapshot with per second rates every
+    interval seconds and can serve the Prometheus text format on a local
+    HTTP port. Run metrics.py on a snapshot file to print it.
+"""
+
+import os
+import json
+import bisect
+import logging
+import argparse
+from time import perf_counter, monotonic
+from datetime import datetime
+from functools import wraps
+from threading import Thread, Event
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger('metrics')
+
+PREFIX = 'aeris_'
+# upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+class Histogram:
+
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, sec):
+        self.counts[bisect.bisect_left(BUCKETS, sec)] += 1
+        self.count += 1
+        self.sum += sec
+        if sec > self.max:
+            self.max = sec
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the q quantile """
+        if self.count == 0:
+            return None
+        rank, n = q * self.count, 0
+        for bound, c in zip(BUCKETS, self.counts):
+            n += c
+            if n >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5), 'p99': self.quantile(0.99), 'max': self.max,
+            'buckets': list(self.counts)}
+
+
+class Timer:
+
+    __slots__ = ('hist', 't0')
+
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.t0 = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(perf_counter() - self.t0)
+
+
+class Metrics:
+
+    def __init__(self):
+        self.counters = {}
+        self.funcs = {}         # counters read from other objects
+        self.histograms = {}
+        self.rates = {}         # per second, over the last snapshot interval
+        self.started = monotonic()
+        self._last = (self.started, {})
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def counter_func(self, name, func):
+        """ A counter kept elsewhere, func() returns its current value """
+        self.funcs[name] = func
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def observe(self, name, sec):
+        self.histogram(name).observe(sec)
+
+    def time(self, name):
+        """ Context manager timing the block into histogram name """
+        return Timer(self.histogram(name))
+
+    def timed(self, name):
+        """ Decorator timing each call into histogram name """
+        def decorator(func):
+            hist = self.histogram(name)
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                t0 = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    hist.observe(perf_counter() - t0)
+            return wrapper
+        return decorator
+
+    def values(self):
+        values = dict(self.counters)
+        for name, func in list(self.funcs.items()):
+            try:
+                values[name] = func()
+            except Exception:       # the object behind func went away
+                pass
+        return values
+
+    def update_rates(self):
+        """ Per second rate of each counter since the last call """
+        now, values = monotonic(), self.values()
+        t, last = self._last
+        if now > t:
+            self.rates = {name: (v - last.get(name, 0)) / (now - t) for name, v in values.items()}
+        self._last = (now, values)
+        return values
+
+    def snapshot(self):
+        values = self.update_rates()
+        return {'time': datetime.utcnow().isoformat(timespec='seconds'),
+            'uptime': monotonic() - self.started,
+            'counters': values,
+            'rates': self.rates,
+            'latency': {name: h.summary() for name, h in list(self.histograms.items())},
+            'buckets': list(BUCKETS)}
+
+    def prometheus(self):
+        """ Prometheus text exposition format """
+        out = []
+        for name, v in sorted(self.values().items()):
+            out += [f'# TYPE {PREFIX}{name}_total counter', f'{PREFIX}{name}_total {v}']
+        for name, v in sorted(self.rates.items()):
+            out += [f'# TYPE {PREFIX}{name}_per_second gauge', f'{PREFIX}{name}_per_second {v:.6g}']
+        for name, h in sorted(self.histograms.items()):
+            n = f'{PREFIX}{name}_seconds'
+            out.append(f'# TYPE {n} histogram')
+            cum = 0
+            for bound, c in zip(BUCKETS + ('+Inf',), h.counts):
+                cum += c
+                out.append(f'{n}_bucket{{le="{bound}"}} {cum}')
+            out += [f'{n}_sum {h.sum:.6g}', f'{n}_count {h.count}']
+        return '\n'.join(out) + '\n'
+
+    def reset(self):
+        self.__init__()
+
+
+metrics = Metrics()     # the registry used by the acquisition code
+
+
+class MetricsExporter(Thread):
+    """ Writes metrics.snapshot() to file every interval seconds (the file
+        is replaced atomically) and optionally serves metrics.prometheus()
+        on http://127.0.0.1:port/metrics """
+
+    def __init__(self, file=None, interval=10, port=None, registry=metrics):
+        Thread.__init__(self, daemon=True)
+        self.file = file
+        self.interval = interval
+        self.registry = registry
+        self.server = None
+        self._done = Event()
+        if port:
+            self.server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+            self.server.daemon_threads = True
+            Thread(target=self.server.serve_forever, daemon=True).start()
+            log.info(f'metrics on http://127.0.0.1:{port}/metrics')
+
+    def handler(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snap = self.registry.snapshot()
+        if self.file is None:
+            return
+        tmp = f'{self.file}.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(snap, f, indent=1)
+            os.replace(tmp, self.file)
+        except OSError as e:
+            log.error(f'metrics snapshot: {e}')
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        self.write()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def print_snapshot(snap):
+    print(f'{snap["time"]} UTC, up {snap["uptime"]:.0f} s')
+    for name, v in sorted(snap['counters'].items()):
+        print(f'{name:<24}{v:>14}{snap["rates"].get(name, 0):>12.1f} /s')
+    print(f'\n{"latency (ms)":<24}{"count":>10}{"mean":>10}{"p50":>10}{"p99":>10}{"max":>10}')
+    for name, h in sorted(snap['latency'].items()):
+        if h['count']:
+            print(f'{name:<24}{h["count"]:>10}{h["mean"]*1000:>10.2f}{h["p50"]*1000:>10.2f}'
+                f'{h["p99"]*1000:>10.2f}{h["max"]*1000:>10.2f}')
+
+
+if __name__ == '__main__':
+
+    opt = argparse.ArgumentParser(description='Print an Aeris metrics snapshot file.')
+    opt.add_argument('file', nargs='?', default='aeris-metrics.json',
+        help='Snapshot file (default aeris-metrics.json).')
+    options = opt.parse_args()
+
+    with open(options.file) as f:
+        print_snapshot(json.load(f))
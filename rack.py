@@ -0,0 +1,168 @@
+#! /usr/bin/env python
+""" Runs several Aeris analyzer / SSV pairs from one process.
+
+    The instruments are listed in config.instruments, each entry overrides
+    the config.py settings for one analyzer. Every instrument runs its
+    own valve sequence in its own thread, with its own reader thread,
+    data, gaps and live data files, so a stalled port or valve only holds
+    up its own instrument. SSVs on the same serial port share one
+    ValcoBus (valco.shared_bus). The supervisor prints a status line for
+    each instrument, runs the metrics exporter for the whole process and
+    stops every instrument (valves home, files closed) on Ctrl-C.
+
+    With --asyncio all of the instruments run as tasks of one event loop
+    (see aioengine.py) instead of threads.
+"""
+
+import asyncio
+import logging
+import argparse
+from time import sleep, monotonic
+from types import SimpleNamespace
+from datetime import datetime
+from threading import Thread
+
+from aeris import Instrument
+from metrics import MetricsExporter
+from journal import ResumeState
+import config as cfg
+
+log = logging.getLogger('rack')
+
+# process wide outputs, the rack runs them once instead of per instrument
+RACK_DEFAULTS = {'live_port': None, 'metrics_file': None, 'metrics_port': None, 'echo': False}
+
+
+def instrument_settings(entry):
+    """ The config.py settings of one config.instruments entry """
+    if 'name' not in entry:
+        raise ValueError(f'config.instruments entry without a name: {entry}')
+    s = {name: value for name, value in vars(cfg).items() if not name.startswith('_')}
+    s.update(RACK_DEFAULTS)
+    s['aeris_datafile_fmt'] = f'{entry["name"]}-{cfg.aeris_datafile_fmt}'
+    if cfg.journal_file:
+        s['journal_file'] = f'{entry["name"]}-{cfg.journal_file}'
+    s.update(entry)
+    if 'aeris_datafile' not in entry:
+        s['aeris_datafile'] = datetime.utcnow().strftime(s['aeris_datafile_fmt'])
+    return SimpleNamespace(**s)
+
+
+def duplicates(values):
+    return sorted({v for v in values if values.count(v) > 1})
+
+
+class Rack:
+
+    status_interval = 10    # seconds between status lines
+
+    def __init__(self, instruments, use_asyncio=False, resume=False):
+        """ resume: only run the instruments with an interrupted sequence in
+            their journal, from where they stopped (see journal.py) """
+        settings = [instrument_settings(entry) for entry in instruments]
+        for key in ('name', 'aeris_port', 'live_port'):
+            dup = duplicates([getattr(s, key) for s in settings if getattr(s, key) is not None])
+            if dup:
+                raise ValueError(f'config.instruments: {key} {", ".join(map(str, dup))} used twice')
+        self.resume = {}        # name: ResumeState
+        if resume:
+            for s in settings:
+                state = ResumeState.load(s.journal_file) if s.journal_file else None
+                if state is None or state.ended:
+                    print(f'{s.name}: nothing to resume')
+                    continue
+                print(f'{s.name} resuming: {state}')
+                s.aeris_datafile = state.datafile
+                self.resume[s.name] = state
+            settings = [s for s in settings if s.name in self.resume]
+        self.use_asyncio = use_asyncio
+        if use_asyncio:
+            from aioengine import AsyncInstrument
+            self.instruments = [AsyncInstrument(settings=s) for s in settings]
+        else:
+            self.instruments = [Instrument(continuous=s.continuous, settings=s) for s in settings]
+        self.failed = {}        # name: exception
+        self.exporter = None
+        if cfg.metrics_file or cfg.metrics_port:
+            self.exporter = MetricsExporter(cfg.metrics_file, cfg.metrics_interval, cfg.metrics_port)
+
+    def status(self):
+        for inst in self.instruments:
+            state = 'failed' if inst.name in self.failed else f'step {inst.step}'
+            gaps = '' if inst.gaps is None else f'  {inst.gaps.completeness():.2f} % complete'
+            print(f'{datetime.now()} {inst.name:<12}{state:<18}packets {inst.framer.packets}{gaps}')
+
+    def guard(self, inst):
+        """ Runs one instrument, a failure does not stop the others """
+        try:
+            state = self.resume.get(inst.name)
+            if state is None:
+                inst.run(inst.cfg.seq)
+            else:
+                inst.run(state.seq, resume=state)
+        except Exception as e:
+            self.failed[inst.name] = e
+            log.exception(f'{inst.name} stopped')
+            print(f'{inst.name} stopped: {e!r}')
+
+    def run_threads(self):
+        threads = [Thread(target=self.guard, args=(inst,), name=inst.name, daemon=True)
+            for inst in self.instruments]
+        for t in threads:
+            t.start()
+        try:
+            next_status = monotonic() + self.status_interval
+            while any(t.is_alive() for t in threads):
+                sleep(0.5)
+                if monotonic() >= next_status:
+                    self.status()
+                    next_status += self.status_interval
+        except KeyboardInterrupt:
+            print('stopping all instruments')
+            for inst in self.instruments:
+                inst.stop()
+            for t in threads:
+                t.join()
+
+    async def guard_async(self, inst):
+        try:
+            await inst.main(inst.cfg.seq)
+        except Exception as e:
+            self.failed[inst.name] = e
+            log.exception(f'{inst.name} stopped')
+            print(f'{inst.name} stopped: {e!r}')
+        finally:
+            inst.close()
+
+    async def main(self):
+        await asyncio.gather(*(self.guard_async(inst) for inst in self.instruments))
+
+    def run(self):
+        if self.exporter is not None:
+            self.exporter.start()
+        try:
+            if self.use_asyncio:
+                asyncio.run(self.main())
+            else:
+                self.run_threads()
+        finally:
+            if self.exporter is not None:
+                self.exporter.stop()
+        self.status()
+
+
+if __name__ == '__main__':
+
+    opt = argparse.ArgumentParser(description='Run the Aeris instruments in config.instruments.')
+    opt.add_argument('--asyncio', action='store_true',
+        help='Run every instrument in one asyncio event loop instead of threads.')
+    opt.add_argument('--resume', action='store_true',
+        help='Finish the interrupted sequences in the instrument journals.')
+    options = opt.parse_args()
+    if options.resume and options.asyncio:
+        opt.error('--resume is not supported by the asyncio engine')
+
+    if len(cfg.instruments) == 0:
+        print('No instruments in config.instruments, use aeris.py for a single instrument.')
+        quit()
+    Rack(cfg.instruments, use_asyncio=options.asyncio, resume=options.resume).run()
@@ -0,0 +1,139 @@
+#! /usr/bin/env python
+""" Mergeable running statistics (Welford / Chan et al.).
+
+    A RunningStats holds count, mean and the sum of squared deviations.
+    Values can be pushed one at a time or as arrays, and two RunningStats
+    can be merged, so partial results from chunks, files or processes
+    combine into exactly the same mean and std as a single pass.
+
+    LiveStats keeps RunningStats for each valve step while aeris.py runs,
+    fed with the records parsed by columnar.RecordBatch.
+"""
+
+import math
+import numpy as np
+
+
+class RunningStats:
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2        # sum of squared deviations from the mean
+
+    @classmethod
+    def from_array(cls, a):
+        """ Statistics of an array, NaNs are skipped like pandas does """
+        a = np.asarray(a, dtype=float)
+        a = a[~np.isnan(a)]
+        if len(a) == 0:
+            return cls()
+        mean = a.mean()
+        return cls(len(a), float(mean), float(((a - mean)**2).sum()))
+
+    def push(self, x):
+        """ Welford update with a single value """
+        if math.isnan(x):
+            return
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.m2 += d * (x - self.mean)
+
+    def push_array(self, a):
+        self.merge(RunningStats.from_array(a))
+
+    def merge(self, other):
+        """ Combine other into self """
+        if other.n == 0:
+            return self
+        n = self.n + other.n
+        d = other.mean - self.mean
+        self.mean += d * other.n / n
+        self.m2 += other.m2 + d * d * self.n * other.n / n
+        self.n = n
+        return self
+
+    def copy(self):
+        return RunningStats(self.n, self.mean, self.m2)
+
+    @property
+    def std(self):
+        """ sample standard deviation (ddof=1), same as pandas std """
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else math.nan
+
+    @property
+    def pct(self):
+        """ population std in percent of the mean, same as stats.pct """
+        if self.n == 0 or self.mean == 0:
+            return math.nan
+        return math.sqrt(self.m2 / self.n) / self.mean * 100
+
+    def row(self):
+        """ mean, std, pct, count """
+        return (self.mean if self.n else math.nan, self.std, self.pct, self.n)
+
+    def __repr__(self):
+        return f'RunningStats(n={self.n}, mean={self.mean}, std={self.std})'
+
+
+class LiveStats:
+    """ Running N2O and CO statistics for each (ssv_position, seq_count)
+        step of a valve sequence, updated as packets arrive. The first 1/3
+        of each step is discarded to let the gas settle, the same rule
+        stats.py applies after the run. The cut is made per record on the
+        instrument time stamps, from the first record of the step, so it
+        doesn't depend on when the records are read. """
+
+    def __init__(self, fields=('n2o', 'co')):
+        """ fields: record fields (see columnar.DTYPE) to follow """
+        self.fields = fields
+        self.steps = {}         # (ssv_position, seq_count): {field: RunningStats}
+        self.key = None
+        self.settle = None      # timedelta64 from the first record to the cut
+        self.settled = None     # time stamp of the cut in the current step
+
+    def start(self, ssv_position, seq_count, duration):
+        """ Called when the valve moves to the next step """
+        self.key = (ssv_position, seq_count)
+        self.steps.setdefault(self.key, {f: RunningStats() for f in self.fields})
+        self.settle = np.timedelta64(int(duration * 1000 / 3), 'ms')
+        self.settled = None
+
+    def push(self, records):
+        """ records: array of columnar.DTYPE records of the current step """
+        if self.key is None or len(records) == 0:
+            return
+        t = records['datetime']
+        if self.settled is None:
+            stamped = t[~np.isnat(t)]
+            if len(stamped) == 0:
+                return
+            self.settled = stamped[0] + self.settle
+        keep = t >= self.settled
+        if not keep.any():
+            return
+        st = self.steps[self.key]
+        for f in self.fields:
+            st[f].push_array(records[f][keep])
+
+    def line(self, label, st):
+        txt = [f'{label}  n={st[self.fields[0]].n:<5d}']
+        for f in self.fields:
+            mean, std, pct, n = st[f].row()
+            txt.append(f'{f} {mean:.6f} {std:.6f} {pct:.3f}%')
+        return '  '.join(txt)
+
+    def step_summary(self):
+        """ Summary of the current step """
+        ssv, seq = self.key
+        return self.line(f'SSV {ssv:2d} seq {seq:2d}', self.steps[self.key])
+
+    def summary(self):
+        """ Summary of every ssv position over all of the steps """
+        by_ssv = {}
+        for (ssv, seq), st in sorted(self.steps.items()):
+            merged = by_ssv.setdefault(ssv, {f: RunningStats() for f in self.fields})
+            for f in self.fields:
+                merged[f].merge(st[f])
+        return '\n'.join(self.line(f'SSV {ssv:2d}', st) for ssv, st in sorted(by_ssv.items()))
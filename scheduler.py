@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+""" Drift free scheduling of valve sequences.
+
+    Every valve switch gets an absolute time.monotonic() deadline measured
+    from the start of the sequence, so time spent reading, writing or
+    printing during a step does not push back the following steps. The
+    planned and actual time of every switch is recorded and logged.
+"""
+
+import logging
+from time import monotonic
+
+log = logging.getLogger('scheduler')
+
+
+class SequenceScheduler:
+    """ Iterate to run the sequence: yields (ssv_position, seq_count,
+        duration, end) for each step, end is the monotonic deadline of the
+        step. The clock starts when the first step is requested. Call
+        switched() right after the valve has moved. """
+
+    def __init__(self, seq, clock=monotonic):
+        self.seq = seq
+        self.clock = clock
+        self.t0 = None
+        self.offsets = []       # planned start of each step from t0
+        t = 0
+        for ssv_position, seq_count, duration in seq:
+            self.offsets.append(t)
+            t += duration
+        self.offsets.append(t)  # end of the sequence, valve goes home
+        self.steps = []         # (step, ssv_position, seq_count, planned, actual)
+        self.step = None
+
+    def __iter__(self):
+        self.t0 = self.clock()
+        for n, (ssv_position, seq_count, duration) in enumerate(self.seq):
+            self.step = (n, ssv_position, seq_count)
+            yield ssv_position, seq_count, duration, self.t0 + self.offsets[n+1]
+        self.step = (len(self.seq), 'home', None)
+
+    def remaining(self, end):
+        return end - self.clock()
+
+    def switched(self):
+        """ Record the actual time of the switch for the current step """
+        n, ssv_position, seq_count = self.step
+        actual = self.clock() - self.t0
+        planned = self.offsets[n]
+        self.steps.append((n, ssv_position, seq_count, planned, actual))
+        log.info(f'step {n} SSV {ssv_position} planned +{planned:.3f} s '
+            f'actual +{actual:.3f} s ({(actual-planned)*1000:+.0f} ms)')
+
+    def summary(self):
+        late = [actual - planned for n, ssv, seq, planned, actual in self.steps]
+        if len(late) == 0:
+            return 'no valve switches'
+        return (f'{len(late)} valve switches, late by mean {sum(late)/len(late)*1000:.0f} ms, '
+            f'max {max(late)*1000:.0f} ms')
@@ -0,0 +1,206 @@
+#! /usr/bin/env python
+""" Pseudo-terminal simulators of the instruments for tests and benchmarks.
+
+    Each simulator opens a pty pair and answers on the master side from a
+    thread. Point the software at sim.port (the slave side) instead of the
+    real serial port, e.g. set aeris_port and ssv_port in config.py to the
+    ports printed by:
+
+        simulator.py --rate 10 --valves 9:ssv --fragment
+"""
+
+import os
+import re
+import pty
+import tty
+import random
+import select
+import argparse
+from time import sleep, monotonic
+from datetime import datetime
+from threading import Thread, Event
+
+
+def aeris_packet(t, rnd=random):
+    """ One Aeris data packet (bytes, \r\n terminated) stamped t """
+    return (f'{t.strftime("%m/%d/%Y %H:%M:%S.%f")[:23]},1,101.32,45.21,'
+        f'{0.332+rnd.gauss(0, 4e-4):.6f},12.3,{0.152+rnd.gauss(0, 3e-4):.6f},'
+        f'25.1,0,0,0\r\n').encode()
+
+
+class PtySimulator(Thread):
+
+    def __init__(self):
+        Thread.__init__(self, daemon=True)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._done = Event()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class AerisSimulator(PtySimulator):
+    """ Aeris N2O/CO analyzer streaming 11 cell packets.
+        rate: packets per second (1-100 Hz)
+        fragment: write each packet in 1-4 random pieces
+        split_crlf: write the \n of the terminator separately
+        corrupt: fraction of packets with an undecodable byte
+        Output that the reader does not drain is dropped (counted in
+        overflow) like a real serial port would. """
+
+    def __init__(self, rate=1, fragment=False, split_crlf=False, corrupt=0.0, seed=None):
+        super().__init__()
+        self.rate = rate
+        self.fragment = fragment
+        self.split_crlf = split_crlf
+        self.corrupt = corrupt
+        self.rnd = random.Random(seed)
+        self.sent = 0
+        self.overflow = 0
+        os.set_blocking(self.master, False)
+
+    def run(self):
+        t0 = monotonic()
+        while not self._done.is_set():
+            wait = t0 + self.sent / self.rate - monotonic()
+            if wait > 0:
+                sleep(wait)
+            self.send(self.packet())
+            self.sent += 1
+
+    def packet(self):
+        p = aeris_packet(datetime.utcnow(), self.rnd)
+        if self.corrupt and self.rnd.random() < self.corrupt:
+            i = self.rnd.randrange(len(p) - 2)
+            p = p[:i] + b'\xff' + p[i+1:]
+        return p
+
+    def pieces(self, p):
+        body, tail = (p[:-1], p[-1:]) if self.split_crlf else (p, b'')
+        if self.fragment:
+            cuts = sorted(self.rnd.sample(range(1, len(body)), min(len(body)-1, self.rnd.randint(0, 3))))
+            for a, b in zip([0] + cuts, cuts + [len(body)]):
+                yield body[a:b]
+        else:
+            yield body
+        if tail:
+            yield tail
+
+    def send(self, p):
+        """ Writes the pieces of packet p. A piece that doesn't fit in the
+            pty buffer, even in part, ends the packet as an overflow. """
+        for piece in self.pieces(p):
+            try:
+                n = os.write(self.master, piece)
+            except BlockingIOError:
+                n = 0
+            if n < len(piece):
+                self.overflow += 1
+                return
+            if self.fragment or self.split_crlf:
+                sleep(0.001)
+
+
+class ValcoSimulator(PtySimulator):
+    """ Valco valves on one serial bus.
+        valves: {address: 'ssv' or 'gsv'}
+        latency: seconds before each reply
+        Replies are terminated with \\r and start with the valve address
+        when the command was addressed. """
+
+    def __init__(self, valves={1: 'ssv'}, numports=10, latency=0.002):
+        super().__init__()
+        self.valves = valves
+        self.numports = numports
+        self.latency = latency
+        self.pos = {add: 1 if kind == 'ssv' else 'A' for add, kind in valves.items()}
+        self.commands = 0
+
+    def run(self):
+        buf = b''
+        while not self._done.is_set():
+            r, w, x = select.select([self.master], [], [], 0.05)
+            if not r:
+                continue
+            try:
+                buf += os.read(self.master, 1024)
+            except OSError:
+                return
+            *lines, buf = buf.split(b'\n')
+            for line in lines:
+                reply = self.reply(line.decode(errors='replace').strip())
+                if reply is not None:
+                    sleep(self.latency)
+                    os.write(self.master, f'{reply}\r'.encode())
+
+    def reply(self, line):
+        """ The reply to one command, None for no reply """
+        m = re.match(r'(\d*)([a-zA-Z]+)=?(\w*)', line)
+        if m is None:
+            return None
+        self.commands += 1
+        add, cmd, arg = m.groups()
+        cmd = cmd.lower()
+        if add == '':
+            add = next(iter(self.valves))       # single valve, no address
+            prefix = ''
+        else:
+            add = int(add)
+            prefix = str(add)
+        if add not in self.valves:
+            return None
+        kind = self.valves[add]
+
+        if cmd == 'cp':
+            if kind == 'gsv':
+                return f'{prefix}Position is "{self.pos[add]}"'
+            return f'{prefix}Position is = {self.pos[add]}'
+        elif cmd == 'np' and kind == 'ssv':
+            return f'{prefix}NP = {self.numports}'
+        elif cmd == 'id':
+            return f'{prefix}ID = {add}'
+        elif cmd == 'go' and kind == 'ssv' and arg.isdigit():
+            self.pos[add] = int(arg)
+        elif cmd in ('goa', 'gob') and kind == 'gsv':
+            self.pos[add] = cmd[-1].upper()
+        elif cmd == 'to' and kind == 'gsv':
+            self.pos[add] = 'B' if self.pos[add] == 'A' else 'A'
+        return None
+
+
+if __name__ == '__main__':
+
+    opt = argparse.ArgumentParser(description='Aeris and Valco pty simulators.')
+    opt.add_argument('--rate', action='store', type=float, default=1,
+        help='Aeris packets per second (default 1).')
+    opt.add_argument('--fragment', action='store_true',
+        help='Write Aeris packets in random pieces.')
+    opt.add_argument('--split', action='store_true',
+        help='Split the \\r\\n terminator of the Aeris packets.')
+    opt.add_argument('--corrupt', action='store', type=float, default=0,
+        help='Fraction of Aeris packets with a corrupt byte.')
+    opt.add_argument('--valves', action='store', default='9:ssv',
+        help='Valco valves, address:kind list (default 9:ssv).')
+    opt.add_argument('--latency', action='store', type=float, default=0.002,
+        help='Valco reply latency in seconds (default 0.002).')
+    options = opt.parse_args()
+
+    valves = {int(a): k for a, k in (v.split(':') for v in options.valves.split(','))}
+    aeris = AerisSimulator(options.rate, options.fragment, options.split, options.corrupt)
+    valco = ValcoSimulator(valves, latency=options.latency)
+    aeris.start()
+    valco.start()
+    print(f'aeris_port = {aeris.port!r}')
+    print(f'ssv_port = {valco.port!r}')
+    try:
+        while True:
+            sleep(10)
+            print(f'{datetime.now()} aeris packets {aeris.sent} overflow {aeris.overflow} '
+                f'valco commands {valco.commands}')
+    except KeyboardInterrupt:
+        pass
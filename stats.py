@@ -1,31 +1,405 @@
 #! /usr/bin/env python
 
+import io
+import os
+import glob
+import pickle
+import hashlib
 import pandas as pd
 import numpy as np
 import argparse
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+
+from runstats import RunningStats
+
+GASES = ['n2o', 'co']
+COLUMNS = ['datetime', 'ssv', 'seq_count'] + GASES   # columns used in streaming mode
 
 
 def pct(x):
     return np.std(x)/np.mean(x)*100
 
 
-opt = argparse.ArgumentParser(description='Quick stats on Aeris data file.')
-opt.add_argument('csvfile', help='Aeris .csv data file.')
-options = opt.parse_args()
+def load(file):
+    """ Reads an Aeris .csv or .npy data file into a DataFrame indexed
+        by datetime. The .npy file is memory mapped, no text is parsed. """
+    if file.endswith('.npy'):
+        df = pd.DataFrame(np.load(file, mmap_mode='r')).set_index('datetime')
+    else:
+        df = pd.read_csv(file, infer_datetime_format=True, parse_dates=True, index_col='datetime')
+    return df.sort_index()
+
+
+# Settling: the start of each ssv segment is discarded while the gas
+# flushes through. 'third' discards the first 1/3 of each segment.
+# 'detect' cuts where a rolling window of window rows has become stable
+# for both gases: the drift of a linear fit across the window is within
+# slope_k, the std within std_k and the distance of its mean from the
+# mean of the last window of the segment within level_k times the noise
+# (std) of the last window. The level test rejects a flat stretch of the
+# previous gas before the transition starts. Segments without a stable
+# window, or shorter than window, fall back to 'third'. All segments are done at once with
+# whole frame rolling and groupby transform operations.
+
+SETTLE_MODES = ('third', 'detect')
+
+
+def settle(df, mode='third', window=10, slope_k=1.0, std_k=1.5, level_k=1.0):
+    """ Returns (keep, cuts): boolean array of the rows after the settling
+        cut and a table of the cut point of each segment (state). Adds the
+        state column (a new state at each ssv switch) to df. """
+    if mode not in SETTLE_MODES:
+        raise ValueError(f'settle mode {mode} is not one of {SETTLE_MODES}')
+    # state keeps track of ssv transitions
+    df['state'] = (df['ssv'].diff() != 0).cumsum()
+    state = df['state'].to_numpy()
+    groups = df.groupby('state', sort=False)
+    pos = groups.cumcount().to_numpy()
+    size = groups['ssv'].transform('size').to_numpy()
+    cut = size // 3
+    method = np.full(len(df), 'third', dtype=object)
+
+    if mode == 'detect' and len(df):
+        w = window
+        settled = pos >= w - 1      # the window is inside the segment
+        rows = pd.Series(pos, dtype=float)
+        last = pos == size - 1      # the last window of each segment ends here
+        for gas in GASES:
+            y = pd.Series(df[gas].to_numpy(dtype=float))
+            roll = y.rolling(w)
+            noise = roll.std().to_numpy()
+            level = roll.mean().to_numpy()
+            # slope per row of a least squares line, var of w consecutive rows is w(w+1)/12
+            drift = np.abs(roll.cov(rows).to_numpy() / (w * (w + 1) / 12)) * (w - 1)
+            final = pd.DataFrame({'noise': noise, 'level': level})[last].reindex(range(len(df)))
+            final = final.groupby(state).transform('last')
+            ref = final['noise'].to_numpy()
+            settled &= (drift <= slope_k * ref) & (noise <= std_k * ref) \
+                & (np.abs(level - final['level'].to_numpy()) <= level_k * ref)
+        first = pd.Series(np.where(settled, pos - (w - 1), np.inf)).groupby(state).transform('min').to_numpy()
+        found = np.isfinite(first)
+        cut = np.where(found, first, cut).astype(int)
+        method[found] = 'detect'
+
+    keep = pos >= cut
+    times = pd.Series(df['datetime'].to_numpy() if 'datetime' in df else df.index.to_numpy())
+    if times.dtype == object:
+        times = pd.to_datetime(times, format='%m/%d/%Y %H:%M:%S.%f')
+    start, at_cut = pos == 0, pos == cut
+    cuts = pd.DataFrame({'ssv': df['ssv'].to_numpy()[start],
+        'seq_count': df['seq_count'].to_numpy()[start],
+        'start': times.to_numpy()[start], 'rows': size[start], 'cut': cut[start],
+        'method': method[start]}, index=pd.Index(state[start], name='state'))
+    cut_time = pd.Series(times.to_numpy()[at_cut], index=state[at_cut])
+    cuts['seconds'] = (cut_time.reindex(cuts.index) - cuts['start']).dt.total_seconds()
+    return keep, cuts
+
+
+def trim(df, mode='third', window=10):
+    """ Discards the data of each ssv segment before the gas settled,
+        by default the first 1/3 of the segment (see settle) """
+    keep, cuts = settle(df, mode, window)
+    return df[keep]
+
+
+def tables(df2):
+    """ Statistics on each ssv position for each valve sequence and
+        on each ssv position for all valve sequences. """
+    by_segment = df2.groupby(['state', 'seq_count', 'ssv'])[GASES].agg(['mean', 'std', pct, 'count'])
+    by_ssv = df2.groupby(['ssv'])[GASES].agg(['mean', 'std', pct, 'count'])
+    return by_segment, by_ssv
+
+
+def report(by_segment, by_ssv, cuts=None):
+    # stats on each ssv position for each valve sequence
+    print(by_segment)
+
+    # stats on each ssv position for all valve sequences.
+    print('\n\nStatistics on each SSV:\n')
+    print(by_ssv)
+
+    if cuts is not None:
+        print('\n\nSettling cut point of each segment:\n')
+        print(cuts.to_string())
+
+
+# Streaming mode: the data file is read in chunks and only the rows of
+# the open ssv segment are held in memory. Rows must be in time order,
+# as written by aeris.py.
+
+
+def iter_chunks(file, offset=0, chunk_mb=16):
+    """ Yields (DataFrame, offset) for the rows of file after offset.
+        offset is a byte offset for .csv files and a row number for .npy
+        files. A partly written last line is left for the next read. """
+    size = int(chunk_mb * 1024**2)
+    if file.endswith('.npy'):
+        a = np.load(file, mmap_mode='r')
+        step = max(1, size // a.dtype.itemsize)
+        for i in range(offset, len(a), step):
+            block = a[i:i+step]
+            yield pd.DataFrame({c: block[c] for c in COLUMNS}), i + len(block)
+        return
+
+    with open(file, 'rb') as f:
+        names = f.readline().decode().strip().split(',')
+        offset = max(offset, f.tell())
+        f.seek(offset)
+        rest = b''
+        while True:
+            data = f.read(size)
+            if not data:
+                return
+            block = rest + data
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            if end == 0:
+                continue
+            offset += end
+            df = pd.read_csv(io.BytesIO(block[:end]), names=names, header=None, usecols=COLUMNS)
+            yield df, offset
+
+
+class SegmentStats:
+    """ Streaming equivalent of trim() followed by tables().
+        Rows are fed in order. A segment (state) is closed when the ssv
+        changes, then the rows before its settling cut are discarded and
+        the remainder is reduced to RunningStats per seq_count. """
+
+    def __init__(self, mode='third', window=10):
+        self.settle = (mode, window)
+        self.state = 0
+        self.ssv = None     # ssv of the open segment
+        self.open = []      # DataFrame pieces of the open segment
+        self.segments = []  # (state, seq_count, ssv, start, {gas: RunningStats})
+        self.cuts = []      # settle() cut point of each closed segment
+
+    def feed(self, df):
+        ssv = df['ssv'].values
+        bounds = [0, *(np.flatnonzero(np.diff(ssv) != 0) + 1), len(df)]
+        for a, b in zip(bounds[:-1], bounds[1:]):
+            if ssv[a] != self.ssv:
+                self.close()
+                self.state += 1
+                self.ssv = ssv[a]
+            self.open.append(df.iloc[a:b])
+
+    def close(self):
+        """ Close the open segment """
+        if len(self.open) == 0:
+            return
+        seg = pd.concat(self.open, ignore_index=True)
+        self.open = []
+        start = seg['datetime'].iloc[0]
+        cut, method = len(seg) // 3, 'third'
+        if self.settle[0] != 'third':
+            keep, cuts = settle(seg, *self.settle)
+            cut, method = cuts['cut'].iloc[0], cuts['method'].iloc[0]
+        self.cuts.append({'state': self.state, 'ssv': self.ssv, 'seq_count': seg['seq_count'].iloc[0],
+            'start': start, 'rows': len(seg), 'cut': cut, 'method': method,
+            'cut_time': seg['datetime'].iloc[cut]})
+        seg = seg.iloc[cut:]
+        for seq, g in seg.groupby('seq_count'):
+            self.segments.append((self.state, seq, self.ssv, start,
+                {gas: RunningStats.from_array(g[gas].values) for gas in GASES}))
+
+    def tables(self):
+        """ The two tables of tables(), built from the closed segments """
+        by_ssv = {}
+        for state, seq, ssv, start, st in self.segments:
+            merge(by_ssv, (ssv,), st)
+        return (stats_table({s[:3]: s[4] for s in self.segments}, ['state', 'seq_count', 'ssv']),
+            stats_table(by_ssv, ['ssv']))
+
+    def cut_table(self):
+        """ The cut table of settle() for the closed segments """
+        if len(self.cuts) == 0:
+            return None
+        cuts = pd.DataFrame(self.cuts).set_index('state')
+        times = {}
+        for col in ('start', 'cut_time'):
+            times[col] = cuts[col] if cuts[col].dtype != object else \
+                pd.to_datetime(cuts[col], format='%m/%d/%Y %H:%M:%S.%f')
+        cuts['start'] = times['start']
+        cuts['seconds'] = (times['cut_time'] - times['start']).dt.total_seconds()
+        return cuts.drop(columns='cut_time')
+
+
+def merge(groups, key, st):
+    """ Merge {gas: RunningStats} st into groups[key] """
+    if key not in groups:
+        groups[key] = {gas: RunningStats() for gas in GASES}
+    for gas in GASES:
+        groups[key][gas].merge(st[gas])
+
+
+def stats_table(groups, names):
+    """ {key tuple: {gas: RunningStats}} to a table laid out like tables() """
+    keys = sorted(groups)
+    if len(names) == 1:
+        index = pd.Index([k[0] for k in keys], name=names[0])
+    else:
+        index = pd.MultiIndex.from_arrays(list(zip(*keys)) or [[]]*len(names), names=names)
+    columns = pd.MultiIndex.from_product([GASES, ['mean', 'std', 'pct', 'count']])
+    df = pd.DataFrame([[v for gas in GASES for v in groups[k][gas].row()] for k in keys],
+        index=index, columns=columns)
+    for gas in GASES:
+        df[(gas, 'count')] = df[(gas, 'count')].astype(int)
+    return df
+
+
+def file_segments(file, chunk_mb=16, cache=False, mode='third', window=10):
+    """ Streams a data file, returns the closed SegmentStats.
+        With cache=True only the rows added since the last call are read
+        (see load_cache). """
+    seg, offset = SegmentStats(mode, window), 0
+    if cache:
+        seg, offset = load_cache(file, mode, window)
+    for df, offset in iter_chunks(file, offset, chunk_mb):
+        seg.feed(df)
+    if cache:
+        save_cache(file, seg, offset)
+    seg.close()
+    return seg
+
+
+def stream(file, chunk_mb=16, cache=False, mode='third', window=10):
+    """ Statistics of a data file with memory bounded by chunk_mb and
+        the length of one ssv segment. Returns the two tables and the
+        settling cut points. """
+    seg = file_segments(file, chunk_mb, cache, mode, window)
+    return (*seg.tables(), seg.cut_table())
+
+
+# Incremental cache: a sidecar file (data file + '.stats') keeps the offset
+# already processed, the closed segment statistics and the still open last
+# segment. Rerunning on a growing data file only reads the appended rows.
+
+CACHE_VERSION = 2
+
+
+def fingerprint(file, nbytes):
+    """ Hash of the start of the data (after the .npy header, which changes) """
+    with open(file, 'rb') as f:
+        f.seek(1024 if file.endswith('.npy') else 0)
+        return hashlib.sha1(f.read(nbytes)).hexdigest()
+
+
+def load_cache(file, mode='third', window=10):
+    """ Returns (SegmentStats, offset) from the cache of file. A missing,
+        stale or unreadable cache, or one made with other settle options,
+        starts from the beginning of the file. """
+    try:
+        with open(f'{file}.stats', 'rb') as f:
+            c = pickle.load(f)
+        if c['version'] == CACHE_VERSION and c['path'] == os.path.abspath(file) \
+                and c['size'] <= os.path.getsize(file) \
+                and c['seg']['settle'] == (mode, window) \
+                and c['fp'] == fingerprint(file, c['fpbytes']):
+            seg = SegmentStats()
+            seg.__dict__.update(c['seg'])
+            return seg, c['offset']
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+    return SegmentStats(mode, window), 0
+
+
+def save_cache(file, seg, offset):
+    """ Cache the state of seg before its open segment is closed """
+    st = os.stat(file)
+    fpbytes = min(4096, st.st_size)
+    c = {'version': CACHE_VERSION, 'path': os.path.abspath(file),
+        'size': st.st_size, 'mtime': st.st_mtime, 'offset': offset,
+        'fp': fingerprint(file, fpbytes), 'fpbytes': fpbytes, 'seg': vars(seg)}
+    tmp = f'{file}.stats.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(c, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, f'{file}.stats')
+
+
+# Campaign mode: many data files (one per aeris.py run) are streamed in
+# a process pool and their per segment statistics merged. The files of
+# rack.py are named <name>-aeris-..., SSV positions of each instrument
+# are kept apart.
+
+
+def data_files(path):
+    """ Data files in a directory or matching a glob pattern. When a run
+        has both a .csv and a .npy file the .npy file is used. The
+        <datafile>-gaps.csv files of gaps.py are skipped. """
+    if os.path.isdir(path):
+        path = os.path.join(path, '*aeris-*')
+    files = {}
+    for file in sorted(glob.glob(path)):
+        root, ext = os.path.splitext(file)
+        if root.endswith('-gaps'):
+            continue
+        if ext == '.npy' or (ext == '.csv' and root not in files):
+            files[root] = file
+    return sorted(files.values())
+
+
+def instrument(file):
+    """ Instrument name of a rack.py data file, '' for aeris.py files """
+    return os.path.basename(file).rpartition('aeris-')[0].rstrip('-')
+
+
+def campaign(files, jobs=None, by_date=False, chunk_mb=16, cache=False, mode='third', window=10):
+    """ Statistics on each ssv position for each file and for all of
+        the files, optionally by date (UTC date of the segment start).
+        Files are processed in parallel, one worker per file. """
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(file_segments, files, repeat(chunk_mb), repeat(cache),
+            repeat(mode), repeat(window)))
 
-file = options.csvfile
-df = pd.read_csv(file, infer_datetime_format=True, parse_dates=True, index_col='datetime')
-df = df.sort_index()
+    named = any(instrument(file) for file in files)
+    by_file, by_ssv = {}, {}
+    for file, seg in zip(files, results):
+        name = (instrument(file),) if named else ()
+        for state, seq, ssv, start, st in seg.segments:
+            merge(by_file, (os.path.basename(file), ssv), st)
+            merge(by_ssv, name + ((pd.Timestamp(start).date(), ssv) if by_date else (ssv,)), st)
+    keys = ['instrument'] if named else []
+    return (stats_table(by_file, ['file', 'ssv']),
+        stats_table(by_ssv, keys + (['date', 'ssv'] if by_date else ['ssv'])))
 
-# state keeps track of ssv transitions
-df['state'] = (df['ssv'].diff() != 0).cumsum()
 
-# discard the first 1/3 of the data after a ssv switch
-df2 = df.groupby(['state'], as_index=False).apply(lambda x: x.iloc[x.ssv.size//3:]).reset_index(level=0, drop=True)
+if __name__ == '__main__':
 
-# stats on each ssv position for each valve sequence
-print(df2.groupby(['state', 'seq_count', 'ssv'])[['n2o', 'co']].agg(['mean', 'std', pct, 'count']))
+    opt = argparse.ArgumentParser(description='Quick stats on Aeris data file.')
+    opt.add_argument('csvfile', help='Aeris .csv or .npy data file. A directory or '
+        'a quoted glob pattern (\'data/aeris-2021*\') combines many runs.')
+    opt.add_argument('-s', '--stream', action='store_true',
+        help='Read the file in chunks with bounded memory. Rows must be in time order.')
+    opt.add_argument('--chunk', action='store', type=float, default=16, metavar='MB',
+        help='Chunk size for --stream (default 16 MB).')
+    opt.add_argument('-j', '--jobs', action='store', type=int, default=None,
+        help='Number of worker processes for many files (default all cores).')
+    opt.add_argument('--by-date', action='store_true', dest='by_date',
+        help='Group the statistics of many files by date.')
+    opt.add_argument('-c', '--cache', action='store_true',
+        help='Keep a .stats cache next to the data file and only process new rows '
+            'on the next run (implies --stream).')
+    opt.add_argument('--settle', action='store', choices=SETTLE_MODES, default='third',
+        help='Discard the first 1/3 of each segment (third, default) or detect '
+            'where the gases become stable (detect).')
+    opt.add_argument('-w', '--window', action='store', type=int, default=10,
+        help='Rows in the rolling window of --settle detect (default 10).')
+    opt.add_argument('--cuts', action='store_true',
+        help='Print the settling cut point of each segment.')
+    options = opt.parse_args()
+    settle_opts = (options.settle, options.window)
 
-# stats on each ssv position for all valve sequences.
-print('\n\nStatistics on each SSV:\n')
-print(df2.groupby(['ssv'])[['n2o', 'co']].agg(['mean', 'std', pct, 'count']))
+    if os.path.isdir(options.csvfile) or glob.has_magic(options.csvfile):
+        files = data_files(options.csvfile)
+        print(f'{len(files)} data files')
+        report(*campaign(files, options.jobs, options.by_date, options.chunk, options.cache,
+            *settle_opts))
+    elif options.stream or options.cache:
+        by_segment, by_ssv, cuts = stream(options.csvfile, options.chunk, options.cache, *settle_opts)
+        report(by_segment, by_ssv, cuts if options.cuts else None)
+    else:
+        df = load(options.csvfile)
+        keep, cuts = settle(df, *settle_opts)
+        report(*tables(df[keep]), cuts if options.cuts else None)
@@ -6,11 +6,15 @@ import argparse
 import queue
 import logging
 import serial
-from time import sleep, time
+from time import sleep, monotonic
 from datetime import datetime
-from threading import Thread
+from threading import Thread, RLock
+from collections import deque
 
 import autodetect
+from metrics import metrics
+
+log = logging.getLogger('valco')
 
 VERSION = '1.3'
 ''' Added autodetect.py and removed old autodetect code.  GSD 150417
@@ -19,26 +23,30 @@ VERSION = '1.3'
 
 DELAYsend = 0.01
 DELAYloop = 0.1
+DELAYreply = 0.05   # longest wait for the reply to a query
 
+TERM = re.compile(rb'[\r\n]')     # end of a reply line
 
-class Valco_Valve_Commands:
-    """ Commands that work on all Valco valves.
 
-        Not all of the commands are programed.
-        See https://www.vici.com/support/tn/tn413.pdf for two position valve
-        See https://www.vici.com/support/tn/tn415.pdf for multi-postion valve
-        commands.
+class ValcoBus:
+    """ The serial connection shared by all of the Valco valves on a port.
 
+        Writes and query/reply transactions are serialized with a lock, so
+        valves on the same RS-485 daisy chain can be used from several
+        threads. Reply lines are matched by valve address: a transaction
+        returns the reply of its own valve, lines from other addresses
+        (late replies to earlier queries) are logged and dropped.
     """
 
-    def __init__(self, add=None, port=None, baud=9600):
+    def __init__(self, port=None, baud=9600):
         """ autodetects port only if port option is set to None
             baud = 9600 is the factory default from Valco
         """
         self.baud = baud
         self.port = self.auto(port, 'valco')
         self.ser = self.connect()
-        self.add = add
+        self.lock = RLock()
+        self.rx = bytearray()       # received bytes not yet used
 
     def auto(self, port, device):
         if port is None:
@@ -61,30 +69,133 @@ class Valco_Valve_Commands:
             quit()
         return ser
 
-    def send_cmd(self, add, cmd):
+    def send(self, add, cmd):
         """ Send a command to valco valve via serial port. """
         if add is None:
             cmd = f'{cmd}\n'
         else:
             cmd = f'{add}{cmd}\n'
-        self.ser.write(cmd.encode())
-        sleep(DELAYsend)
+        with self.lock:
+            self.ser.write(cmd.encode())
+            sleep(DELAYsend)
 
-    def read_cmd(self, bytes=100):
+    def read(self, bytes=100):
         """ Reads any returned data on the serial port. """
-        # sleep(.05)
-        r = self.ser.read(bytes)
-        self.ser.flushInput()
+        with self.lock:
+            r = self.ser.read(bytes)
+            self.ser.flushInput()
+            self.rx.clear()
         try:
             data = r.decode()
         except UnicodeDecodeError:
             data = ''
         return data
 
+    def transact(self, add, cmd, timeout=DELAYreply):
+        """ Sends a query and returns the reply line of valve add (without
+            the address) as soon as its terminator arrives, or '' after
+            timeout seconds. Echoes and replies from other addresses are
+            dropped, the input buffer is not flushed. """
+        with self.lock:
+            # anything complete before the query belongs to an earlier one
+            self.rx += self.ser.read(self.ser.in_waiting)
+            while True:
+                line = self.read_line(monotonic())
+                if line is None:
+                    break
+                self.route(add, None, line)
+
+            sent = cmd if add is None else f'{add}{cmd}'
+            self.ser.write(f'{sent}\n'.encode())
+            deadline = monotonic() + timeout
+            while True:
+                line = self.read_line(deadline)
+                if line is None:
+                    return ''
+                reply = self.route(add, sent, line)
+                if reply is not None:
+                    return reply
+
+    def read_line(self, deadline):
+        """ Next complete line received, or None at the deadline """
+        while True:
+            m = TERM.search(self.rx)
+            if m is not None:
+                line = bytes(self.rx[:m.start()])
+                del self.rx[:m.end()]
+                if line:
+                    return line
+                continue
+            if monotonic() >= deadline:
+                return None
+            self.rx += self.ser.read(max(1, self.ser.in_waiting))
+
+    def route(self, add, sent, line):
+        """ Returns the reply text if line answers the query sent to add,
+            otherwise logs and drops it. """
+        text = line.decode(errors='replace').strip()
+        if sent is not None and text.lower() == sent.lower():
+            return None     # echo of the query
+        m = re.match(r'(\d+)(.*)', text)
+        if add is not None and m is not None:
+            if sent is None or int(m.group(1)) != int(add):
+                log.debug(f'dropped reply of valve {m.group(1)}: {text}')
+                return None
+            text = m.group(2)
+        return text if sent is not None else None
+
+    def close(self):
+        self.ser.close()
+
+
+_buses = {}
+
+
+def shared_bus(port, baud=9600):
+    """ One ValcoBus per serial port, shared by every valve on that port
+        in the process (e.g. the SSVs of several instruments). """
+    if port not in _buses:
+        _buses[port] = ValcoBus(port, baud)
+    return _buses[port]
+
+
+class Valco_Valve_Commands:
+    """ Commands that work on all Valco valves.
+
+        Not all of the commands are programed.
+        See https://www.vici.com/support/tn/tn413.pdf for two position valve
+        See https://www.vici.com/support/tn/tn415.pdf for multi-postion valve
+        commands.
+
+        Valves on the same serial port should share one ValcoBus.
+    """
+
+    def __init__(self, add=None, port=None, baud=9600, bus=None):
+        """ autodetects port only if port option is set to None
+            baud = 9600 is the factory default from Valco
+            bus: a ValcoBus to use instead of opening port
+        """
+        self.bus = ValcoBus(port, baud) if bus is None else bus
+        self.baud = self.bus.baud
+        self.port = self.bus.port
+        self.ser = self.bus.ser
+        self.add = add
+
+    def send_cmd(self, add, cmd):
+        """ Send a command to valco valve via serial port. """
+        self.bus.send(add, cmd)
+
+    def read_cmd(self, bytes=100):
+        """ Reads any returned data on the serial port. """
+        return self.bus.read(bytes)
+
+    def transact(self, add, cmd, timeout=DELAYreply):
+        """ Query valve add, returns its reply (see ValcoBus.transact) """
+        return self.bus.transact(add, cmd, timeout)
+
     # returns current valve position
     def cp(self, add):
-        self.send_cmd(add, 'cp')
-        r = self.read_cmd()
+        r = self.transact(add, 'cp')
         return self.__parse_cp(r)
 
     # parses cp return into current position of A or B
@@ -100,8 +211,7 @@ class Valco_Valve_Commands:
 
     # returns current id or address
     def id(self):
-        self.send_cmd(self.add, 'id')
-        r = self.read_cmd()
+        r = self.transact(self.add, 'id')
         m = re.search(r'= (\d)', r)
         if m is None:
             return None
@@ -111,8 +221,8 @@ class Valco_Valve_Commands:
 class GSV(Valco_Valve_Commands):
     """ Commands specific to 2 position valves, Gas Sample Valve """
 
-    def __init__(self, add, port=None, baud=9600):
-        super().__init__(port=port, baud=baud)
+    def __init__(self, add, port=None, baud=9600, bus=None):
+        super().__init__(port=port, baud=baud, bus=bus)
         self.add = add
         self.pos = 'Unknown'
         self.verbose = True
@@ -141,14 +251,14 @@ class GSV(Valco_Valve_Commands):
         self.gob()
         if self.verbose:
             print(f'{datetime.now()} load {self.add}')
-            logging.info(f'load {self.add}')
+            log.info(f'load {self.add}')
 
     def inject(self):
         """ 'inject' command is position A """
         self.goa()
         if self.verbose:
             print(f'{datetime.now()} inject {self.add}')
-            logging.info(f'inject {self.add}')
+            log.info(f'inject {self.add}')
 
     def pos_txt(self):
         """ Returns the valve postion as load/inject instead of A/B """
@@ -178,17 +288,18 @@ class SSV(Valco_Valve_Commands):
         Added: self.pos 190607 GSD
     """
 
-    def __init__(self, add, port=None, baud=9600):
-        super().__init__(port=port, baud=baud)
+    def __init__(self, add, port=None, baud=9600, bus=None, metric='ssv_go'):
+        """ metric: name of the go() latency histogram """
+        super().__init__(port=port, baud=baud, bus=bus)
         self.add = add
+        self.metric = metric
         self.pos = -1
         self.numports = self.np()    # num ports on the valve
         self.verbose = True
 
     def np(self):
         """ Returns number of postions a SSV has. """
-        self.send_cmd(self.add, 'np')
-        m = re.search(r'= (\d+)', self.read_cmd())
+        m = re.search(r'= (\d+)', self.transact(self.add, 'np'))
         if m is None:
             sys.stderr.write("Can't determine number of ports on SSV. NP command failed.\n")
             return 0
@@ -203,11 +314,12 @@ class SSV(Valco_Valve_Commands):
         return self.pos
 
     def go(self, position):
-        self.send_cmd(self.add, f'go={position}')
+        with metrics.time(self.metric):
+            self.send_cmd(self.add, f'go={position}')
         self.pos = int(position)
         if self.verbose:
             print(f'{datetime.now()} SSV{self.add} to {position}')
-            logging.info(f'SSV{self.add} to {position}')
+            log.info(f'SSV{self.add} to {position}')
 
     def step(self):
         """ Step valve one postion forward. """
@@ -229,8 +341,8 @@ class SSV(Valco_Valve_Commands):
 class Valves(Valco_Valve_Commands):
     """ Function that apply to many valves. """
 
-    def __init__(self, port=None):
-        super().__init__(port=port)
+    def __init__(self, port=None, bus=None):
+        super().__init__(port=port, bus=bus)
         self.positions = dict()
 
     def scan(self, adds):
@@ -248,6 +360,9 @@ class Driver(Thread):
         vport: The serial port the valves are hooked to.
     """
 
+    # commands that set an absolute position, a later one replaces an earlier one
+    moves = ('gob', 'load', 'calg', 'goa', 'inject', 'korg', 'home')
+
     def __init__(self, ssv_ids, gsv_ids, loop_t=1, vport=None):
         Thread.__init__(self)
         self.gsv_ids = gsv_ids
@@ -256,21 +371,24 @@ class Driver(Thread):
         self.pos = []
         self.GSVs = []
         self.SSVs = []
-        self.job = queue.Queue()
+        self.job = JobQueue()
+        self.latency = deque(maxlen=1000)   # (cmd, seconds from put to run)
 
         if len(self.gsv_ids + self.ssv_ids) == 0:
             print('No Valco valve addresses defined.')
             return
 
-        Vs = Valves(port=vport)
+        # one serial connection shared by all of the valves
+        self.bus = ValcoBus(vport)
+        Vs = Valves(bus=self.bus)
 
         # list of valves that are online
         self.online = Vs.scan(self.ssv_ids + self.gsv_ids)
         self.pos = self.online.copy()
 
         # create valve instances
-        self.GSVs = [GSV(i, port=vport) for i in self.gsv_ids]
-        self.SSVs = [SSV(i, port=vport) for i in self.ssv_ids]
+        self.GSVs = [GSV(i, bus=self.bus) for i in self.gsv_ids]
+        self.SSVs = [SSV(i, bus=self.bus) for i in self.ssv_ids]
 
     # toggles GSV postion
     def tog(self, id):
@@ -322,84 +440,114 @@ class Driver(Thread):
     def run(self):
         """ Called with thread start instance
             Routine will loop through every loop_t seconds and record the current postions
-            of all of the valves while checking to see if any tasks are in the queue to be
-            operated upon.
+            of all of the valves. Between position polls the thread blocks on the job
+            queue, so a posted command runs as soon as it arrives. Pending commands
+            always run before the next position poll.
         """
-        t = time()
+        t = monotonic()
         while True:
-            for n, id in enumerate(self.gsv_ids):
-                if self.online.get(id) is not None:
-                    self.pos[id] = self.GSVs[n].cp()
-                    # print self.pos[id]
-                self.__tasks()
-                sleep(DELAYloop)
-            for n, id in enumerate(self.ssv_ids):
-                if self.online.get(id) is not None:
-                    try:
-                        self.pos[id] = self.SSVs[n].cp()    # FM removed int()  Error trapping probably not needed as in GSV section
-                    except ValueError:
-                        self.pos[id] = None
-                        print('ssv cp trapped Value error')
-                self.__tasks()
-                sleep(DELAYloop)
-
-            # wait until near the end of loop_t while still checking the task queue
-            while self.loop_t - (time() - t) > DELAYloop*2:     # *2 added 190812 GSD
-                self.__tasks()
-                sleep(DELAYloop)
-            tsleep = self.loop_t - (time() - t)
-            if tsleep < 0.0:
-                sys.stderr.write(f'Error  tsleep = {tsleep} ')
-            else:
-                # wait the remaining time
-                sleep(self.loop_t - (time() - t))
-
-            t = time()
+            for valves, ids in ((self.GSVs, self.gsv_ids), (self.SSVs, self.ssv_ids)):
+                for n, id in enumerate(ids):
+                    self.__tasks()
+                    if self.online.get(id) is not None:
+                        try:
+                            self.pos[id] = valves[n].cp()
+                        except ValueError:
+                            self.pos[id] = None
+                            print('cp trapped Value error')
+
+            # wait for commands until the start of the next loop
+            t += self.loop_t
+            while True:
+                timeout = t - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.job.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                self.__tasks([item])
+            if monotonic() - t > self.loop_t:
+                sys.stderr.write(f'Error  loop behind by {monotonic() - t:.3f} s ')
+                t = monotonic()
+
+    def __tasks(self, items=None):
+        """ Runs the job tasks waiting in the queue. A move of a valve that
+            is replaced by a later move of the same valve is skipped. """
+        items = [] if items is None else items
+        while True:
+            try:
+                items.append(self.job.get_nowait())
+            except queue.Empty:
+                break
 
-    def __tasks(self):
-        """ Possible job taskes in queue. """
-        verbose = True
-        if self.job.qsize() > 0:
+        jobs = []
+        last_move = {}      # id: index in jobs of its last absolute move
+        for queued, item in items:
             try:
-                id, cmd = self.job.get()
+                id, cmd = item
             except ValueError:
-                return
-
+                continue
             cmd = cmd.lower()
+            if cmd in self.moves or (cmd[0:2] == 'go' and cmd[2:].isdigit()):
+                if id in last_move:
+                    jobs[last_move[id]] = None      # superseded
+                last_move[id] = len(jobs)
+            else:
+                last_move.pop(id, None)     # relative commands keep their order
+            jobs.append((queued, id, cmd))
+
+        for job in filter(None, jobs):
+            queued, id, cmd = job
+            wait = monotonic() - queued
+            self.latency.append((cmd, wait))
+            log.debug(f'valve {id} {cmd} waited {wait*1000:.1f} ms')
+            self.__task(id, cmd)
+
+    def __task(self, id, cmd):
+        """ Runs one job task """
+        verbose = True
 
-            # GSV commands
-            if cmd == 'tog':
-                self.tog(id)
-            elif cmd == 'gob' or cmd == 'load' or cmd == 'calg':
-                if cmd == 'calg':
-                    print('GSV id={0} cal push gas'.format(id))
-                elif verbose:
-                    print('GSV id={0} loading'.format(id))
-                self.load(id)
-            elif cmd == 'goa' or cmd == 'inject' or cmd == 'korg':
-                if cmd == 'korg':
-                    print('GSV id={0} aircore gas'.format(id))
-                elif verbose:
-                    print('GSV id={0} injecting'.format(id))
-                self.inject(id)
-
-            # SSV Commands
-            elif cmd == 'step':
-                self.SSVs[self.ssv_ids.index(id)].step()
-                if verbose:
-                    print('Step SSV')
-            elif cmd == 'home':
-                self.SSVs[self.ssv_ids.index(id)].home()
-                if verbose:
-                    print('Home SSV')
-            elif cmd[0:2] == 'go':
-                if verbose:
-                    print('SSV to {0}'.format(cmd[2:]))
-                self.SSVs[self.ssv_ids.index(id)].go(int(cmd[2:]))
-
-            elif cmd == 'quit':
-                quit()
-            self.__tasks()
+        # GSV commands
+        if cmd == 'tog':
+            self.tog(id)
+        elif cmd == 'gob' or cmd == 'load' or cmd == 'calg':
+            if cmd == 'calg':
+                print('GSV id={0} cal push gas'.format(id))
+            elif verbose:
+                print('GSV id={0} loading'.format(id))
+            self.load(id)
+        elif cmd == 'goa' or cmd == 'inject' or cmd == 'korg':
+            if cmd == 'korg':
+                print('GSV id={0} aircore gas'.format(id))
+            elif verbose:
+                print('GSV id={0} injecting'.format(id))
+            self.inject(id)
+
+        # SSV Commands
+        elif cmd == 'step':
+            self.SSVs[self.ssv_ids.index(id)].step()
+            if verbose:
+                print('Step SSV')
+        elif cmd == 'home':
+            self.SSVs[self.ssv_ids.index(id)].home()
+            if verbose:
+                print('Home SSV')
+        elif cmd[0:2] == 'go':
+            if verbose:
+                print('SSV to {0}'.format(cmd[2:]))
+            self.SSVs[self.ssv_ids.index(id)].go(int(cmd[2:]))
+
+        elif cmd == 'quit':
+            quit()
+
+
+class JobQueue(queue.Queue):
+    """ Queue that stores the time each item was put on it.
+        put() takes the item as usual, get() returns (monotonic time, item). """
+
+    def _put(self, item):
+        self.queue.append((monotonic(), item))
 
 
 if __name__ == '__main__':
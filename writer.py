@@ -0,0 +1,115 @@
+#! /usr/bin/env python
+""" Long lived, buffered writer for the Aeris data files.
+
+    The file stays open for the whole run. Lines are batched in memory and
+    written out every flush_interval seconds or flush_lines lines,
+    optionally followed by an fsync. A new file is started at 00:00 UTC
+    and/or when the file grows past rotate_bytes. The header is written
+    once at the top of every new file.
+"""
+
+import os
+import logging
+from time import monotonic
+from datetime import datetime
+
+log = logging.getLogger('writer')
+
+
+class DataWriter:
+
+    mode = 'a'
+
+    def __init__(self, path, header, namefmt=None, flush_interval=10,
+            flush_lines=100, fsync=False, rotate_daily=False, rotate_bytes=0):
+        """ path: first data file
+            header: header line (without newline) for each file
+            namefmt: strftime format (UTC) of rotated file names. Rotation
+                is disabled if None. """
+        self.header = header
+        self.namefmt = namefmt
+        self.flush_interval = flush_interval
+        self.flush_lines = flush_lines
+        self.fsync = fsync
+        self.rotate_daily = rotate_daily
+        self.rotate_bytes = rotate_bytes
+        self.pending = []
+        self.queued = 0
+        self.on_rotate = []     # func(path) called with each new file after a rotation
+        self.f = None
+        self.open(path)
+
+    def open(self, path):
+        """ Open path for appending. The header is only written to a new
+            or empty file. """
+        self.path = path
+        self.f = open(path, self.mode)
+        self.f.seek(0, os.SEEK_END)
+        self.size = self.f.tell()      # includes the queued data
+        self.day = datetime.utcnow().date()
+        self.last_flush = monotonic()
+        if self.size == 0 and self.header is not None:
+            self.queue(f'{self.header}\n')
+        log.info(f'data file {path}')
+
+    def encode(self, lines):
+        return '\n'.join(lines) + '\n'
+
+    def queue(self, data):
+        self.pending.append(data)
+        self.size += len(data)
+
+    def write(self, lines):
+        """ Queue a batch of lines (without newlines). Call with an empty
+            batch to flush on time when no data is coming in. """
+        if len(lines):
+            if self.rotation_due():
+                self.rotate()
+            self.queue(self.encode(lines))
+            self.queued += len(lines)
+        if self.queued and (self.queued >= self.flush_lines
+                or monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.f.write(self.pending[0][:0].join(self.pending))
+            self.pending = []
+            self.queued = 0
+            self.commit()
+        self.f.flush()
+        if self.fsync:
+            os.fsync(self.f.fileno())
+        self.last_flush = monotonic()
+
+    def commit(self):
+        """ Called after the queued data is written, before the flush. """
+        pass
+
+    def rotation_due(self):
+        if self.namefmt is None:
+            return False
+        if self.rotate_daily and datetime.utcnow().date() != self.day:
+            return True
+        return self.rotate_bytes > 0 and self.size >= self.rotate_bytes
+
+    def rotate(self):
+        """ Close the current file and start a new one. """
+        path = datetime.utcnow().strftime(self.namefmt)
+        if path == self.path:
+            root, ext = os.path.splitext(path)
+            path = f'{root}-1{ext}'
+        self.reopen(path)
+        for func in self.on_rotate:
+            func(path)
+
+    def reopen(self, path):
+        """ Close the current file and continue in path. """
+        self.close()
+        self.open(path)
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None